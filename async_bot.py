@@ -0,0 +1,461 @@
+import asyncio
+import logging
+import os
+from io import BytesIO
+
+import aiohttp
+from telebot import asyncio_helper, util
+from telebot.async_telebot import AsyncTeleBot
+from yt_dlp_host_api.exceptions import APIError
+
+import config
+import metrics
+import scratch
+from bot import (
+    client, lang, user_states, render_queue, info_cache, gif_cache, preview_cache, membership_cache,
+    is_required_channel,
+    session_keyboard, settings_view, apply_time_input, new_session,
+    parse_batch, clips_fit, batch_ranges_error, batch_clips, add_clip, batch_media,
+    range_alert, queue_alert, build_job, render_progress_text, render_caption,
+    gif_cache_key, preview_cache_key, open_gif,
+    gif_index, index_result, inline_results, subscribe_button, export_cache_stats,
+)
+from render import ENCODER_VERSION, OutputTooLarge, result_size
+from render_queue import QueueFull, UserLimitReached
+from utils import is_youtube_url, extract_video_id
+
+abot = AsyncTeleBot(config.TELEGRAM_BOT_TOKEN)
+_process_request = asyncio_helper._process_request
+
+async def timed_request(token, url, *args, **kwargs):
+    with metrics.telegram_call(url):
+        return await _process_request(token, url, *args, **kwargs)
+
+asyncio_helper._process_request = timed_request
+http = None
+host = None
+loop = None
+_info_in_flight = {}
+
+
+class AsyncHostClient:
+    def __init__(self, session, host_url, headers):
+        self.session = session
+        self.host_url = host_url
+        self.headers = headers
+
+    async def _run_task(self, endpoint, data, max_retries=360, delay=1):
+        async with self.session.post(f"{self.host_url}/{endpoint}", json=data, headers=self.headers) as response:
+            body = await response.json()
+            if response.status != 200:
+                raise APIError(body.get('error', 'Unknown error'))
+            task_id = body['task_id']
+        for _ in range(max_retries):
+            async with self.session.get(f"{self.host_url}/status/{task_id}", headers=self.headers) as response:
+                status = await response.json()
+                if response.status != 200:
+                    raise APIError(status.get('error', 'Unknown error'))
+            if status['status'] == 'completed':
+                return status
+            if status['status'] == 'error':
+                raise APIError(f"Task failed: {status.get('error', 'Unknown error')}")
+            if status['status'] not in ['waiting', 'processing']:
+                raise APIError(f"Unknown task status: {status['status']}")
+            await asyncio.sleep(delay)
+        raise APIError(f"Task did not complete within the expected time (waited {max_retries * delay} seconds)")
+
+    async def get_info(self, url, fields):
+        status = await self._run_task('get_info', {"url": url})
+        file_url = f"{self.host_url}{status['file']}?" + ''.join(f'{field}&' for field in fields)
+        async with self.session.get(file_url, headers=self.headers) as response:
+            if response.status != 200:
+                raise APIError((await response.json()).get('error', 'Unknown error'))
+            return await response.json(content_type=None)
+
+
+async def fetch_video_info(url):
+    with metrics.stage('get_info'):
+        video_data = await host.get_info(url, ['title', 'duration', 'thumbnail', 'width'])
+    thumbnail_bytes = None
+    thumbnail = video_data.get('thumbnail', '')
+    if thumbnail:
+        try:
+            with metrics.stage('thumbnail'):
+                async with http.get(thumbnail, timeout=aiohttp.ClientTimeout(total=10)) as response:
+                    response.raise_for_status()
+                    thumbnail_bytes = await response.read()
+        except Exception as e:
+            logging.warning(f"Could not fetch thumbnail {thumbnail}: {e}")
+    return video_data, thumbnail_bytes
+
+async def get_video_info(url):
+    video_id = extract_video_id(url)
+    cached = info_cache.get(video_id)
+    if cached is not None:
+        return cached
+    task = _info_in_flight.get(video_id)
+    if task is None:
+        task = _info_in_flight[video_id] = asyncio.ensure_future(fetch_video_info(url))
+        task.add_done_callback(lambda _: _info_in_flight.pop(video_id, None))
+    result = await asyncio.shield(task)
+    info_cache.put(video_id, result)
+    return result
+
+async def check_subscription(user_id):
+    if not config.REQUIRED_CHANNEL_ID: return True
+    is_member = membership_cache.lookup(user_id)
+    if is_member is not None:
+        return is_member
+    return await refresh_subscription(user_id)
+
+async def refresh_subscription(user_id):
+    try:
+        member = await abot.get_chat_member(config.REQUIRED_CHANNEL_ID, user_id)
+    except Exception as e:
+        logging.warning(f"Could not check subscription for {user_id}: {e}")
+        return False
+    return membership_cache.update(user_id, member.status)
+
+async def refresh_subscriptions():
+    while True:
+        await asyncio.sleep(config.SUBSCRIPTION_REFRESH_INTERVAL)
+        stale = membership_cache.take_stale(config.SUBSCRIPTION_REFRESH_BATCH)
+        await asyncio.gather(*(refresh_subscription(user_id) for user_id in stale))
+
+async def delete_later(chat_id, message_ids, delay):
+    await asyncio.sleep(delay)
+    for message_id in message_ids:
+        try: await abot.delete_message(chat_id, message_id)
+        except Exception: pass
+
+def from_worker(coroutine_function, wait=False):
+    # render queue callbacks run on worker threads, hand them over to the event loop
+    # (waiting keeps the job's scratch directory around until the result has been sent)
+    def callback(*args):
+        future = asyncio.run_coroutine_threadsafe(coroutine_function(*args), loop)
+        if wait:
+            future.result()
+    return callback
+
+async def update_render_progress(job, stage, position):
+    try:
+        await abot.edit_message_text(render_progress_text(job, stage, position), job['chat_id'], job['process_message_id'])
+    except Exception as e:
+        logging.warning(f"Progress update failed for user {job['user_id']}: {e}")
+
+async def send_result(job, result, caption, cache):
+    gif, applied = result
+    try:
+        with open_gif(gif) as f, metrics.stage('send_animation', job['timings']):
+            sent = await abot.send_animation(job['chat_id'], f, caption=caption)
+        media = sent.animation or sent.document
+        if media and not job.get('downgraded'):
+            if cache is gif_cache:
+                gif_cache.put(job['cache_key'], ENCODER_VERSION, media.file_id)
+            else:
+                cache.put(job['cache_key'], media.file_id)
+        if cache is gif_cache:
+            index_result(job, sent.animation, applied)
+        await abot.delete_message(job['chat_id'], job['process_message_id'])
+        metrics.log_job(job, 'done', result_size(gif))
+        return True
+    finally:
+        if isinstance(gif, str) and os.path.exists(gif): os.unlink(gif)
+
+async def finish_render(job, result):
+    await update_render_progress(job, 'uploading', 0)
+    try:
+        await send_result(job, result, render_caption(job, result[1]), gif_cache)
+    except Exception as e:
+        await fail_render(job, e)
+
+async def finish_batch(job, result):
+    outputs, _ = result
+    files = []
+    await update_render_progress(job, 'uploading', 0)
+    try:
+        files = [open_gif(output, f'clip_{index}.gif') for index, output in enumerate(outputs, 1)]
+        with metrics.stage('send_animation', job['timings']):
+            await abot.send_media_group(job['chat_id'], batch_media(job, files))
+        await abot.delete_message(job['chat_id'], job['process_message_id'])
+        metrics.log_job(job, 'done', sum(result_size(output) for output in outputs))
+    except Exception as e:
+        await fail_render(job, e)
+    finally:
+        for f in files: f.close()
+        for output in outputs:
+            if isinstance(output, str) and os.path.exists(output): os.unlink(output)
+
+async def fail_render(job, error):
+    logging.error(f"Failed to create GIF for user {job['user_id']}. URL: {job['url']}. Error: {error}")
+    metrics.log_job(job, 'too_large' if isinstance(error, OutputTooLarge) else 'error')
+    try: await abot.delete_message(job['chat_id'], job['process_message_id'])
+    except Exception: pass
+    text = lang["error_output_too_large"] if isinstance(error, OutputTooLarge) else lang["error_creating_gif"]
+    await abot.send_message(job['chat_id'], text)
+
+async def finish_preview(job, result):
+    caption = lang["preview_ready"].format(start_time=job['start_time'], end_time=job['end_time'])
+    try:
+        await send_result(job, result, caption, preview_cache)
+    except Exception as e:
+        await fail_preview(job, e)
+
+async def fail_preview(job, error):
+    logging.error(f"Failed to create preview for user {job['user_id']}. URL: {job['url']}. Error: {error}")
+    metrics.log_job(job, 'error')
+    try: await abot.delete_message(job['chat_id'], job['process_message_id'])
+    except Exception: pass
+    await abot.send_message(job['chat_id'], lang["error_creating_preview"])
+
+def job_callbacks(job):
+    # picks up jobs a previous bot process left in the shared job queue
+    on_done, on_error = {'preview': (finish_preview, fail_preview), 'batch': (finish_batch, fail_render)}.get(
+        job.get('kind', 'render'), (finish_render, fail_render))
+    return from_worker(update_render_progress), from_worker(on_done), from_worker(on_error)
+
+async def send_cached(chat_id, cache, key, caption):
+    file_id = cache.get(key)
+    if not file_id:
+        return False
+    try:
+        await abot.send_animation(chat_id, file_id, caption=caption)
+        return True
+    except Exception as e:
+        logging.warning(f"Cached animation {key} could not be sent, dropping it: {e}")
+        cache.discard(key)
+        return False
+
+async def submit_job(job, on_done, on_error):
+    try:
+        position = render_queue.submit(job, from_worker(update_render_progress), from_worker(on_done, True), from_worker(on_error, True))
+        if position:
+            await update_render_progress(job, 'queued', position)
+    except (QueueFull, UserLimitReached):
+        metrics.log_job(job, 'rejected')
+        await abot.delete_message(job['chat_id'], job['process_message_id'])
+        await abot.send_message(job['chat_id'], lang["error_queue_full"])
+
+@abot.message_handler(commands=['start', 'help'])
+@metrics.handler('start')
+async def handle_start(message):
+    if not await check_subscription(message.from_user.id):
+        if config.REQUIRED_CHANNEL_ID:
+            await abot.send_message(message.chat.id, lang["subscribe_prompt"].format(channel_id=config.REQUIRED_CHANNEL_ID))
+            return
+    await abot.send_message(message.chat.id, lang["start_welcome"].format(max_duration=config.MAX_GIF_DURATION))
+
+@abot.message_handler(func=lambda message: True)
+@metrics.handler('message')
+async def handle_message(message):
+    user = message.from_user
+    user_id = user.id
+    username = user.username or user.first_name
+
+    if not await check_subscription(user_id):
+        if config.REQUIRED_CHANNEL_ID:
+            await abot.send_message(message.chat.id, lang["subscribe_prompt"].format(channel_id=config.REQUIRED_CHANNEL_ID))
+            return
+
+    state = user_states.get(user_id)
+    if state and state.get('waiting_for'):
+        prompt_message_id = state.get('prompt_message_id')
+        try:
+            ok, reply = apply_time_input(state, state.get('waiting_for'), message.text)
+            if not ok:
+                await abot.send_message(message.chat.id, reply)
+                return
+
+            state['waiting_for'] = None
+            del state['prompt_message_id']
+            user_states.save(user_id, state)
+
+            confirmation_msg = await abot.send_message(message.chat.id, reply)
+            keyboard = session_keyboard(state)
+            await abot.edit_message_reply_markup(message.chat.id, state['message_id'], reply_markup=keyboard)
+            asyncio.create_task(delete_later(
+                message.chat.id, [prompt_message_id, message.message_id, confirmation_msg.message_id],
+                config.MESSAGE_DELETE_DELAY))
+        except Exception as e:
+            logging.error(f"Error processing time input for user {user_id}: {e}")
+            await abot.send_message(message.chat.id, lang["error_invalid_time_format"])
+        return
+
+    url, clips = parse_batch(message.text)
+    if not is_youtube_url(url):
+        await abot.send_message(message.chat.id, lang["error_invalid_url"])
+        return
+    if clips is None:
+        await abot.send_message(message.chat.id, batch_ranges_error())
+        return
+
+    logging.info(f"User {user_id} ({username}) sent URL: {url}" + (f" with {len(clips)} clips" if clips else ""))
+    loading_msg = await abot.send_message(message.chat.id, lang["getting_info"])
+
+    try:
+        video_data, thumbnail_bytes = await get_video_info(url)
+        if clips and not clips_fit(clips, video_data.get('duration', 0)):
+            await abot.send_message(message.chat.id, batch_ranges_error())
+            return
+        session, caption, keyboard = new_session(url, video_data, clips)
+
+        msg = None
+        if thumbnail_bytes:
+            try:
+                msg = await abot.send_photo(message.chat.id, BytesIO(thumbnail_bytes), caption=caption, parse_mode='Markdown', reply_markup=keyboard)
+            except Exception: pass
+
+        if not msg:
+            msg = await abot.send_message(message.chat.id, caption, parse_mode='Markdown', reply_markup=keyboard)
+
+        session['message_id'] = msg.message_id
+        user_states[user_id] = session
+    except Exception as e:
+        logging.error(f"Failed to get video info for URL {url} by user {user_id}. Error: {e}")
+        await abot.send_message(message.chat.id, lang["error_getting_info"])
+    finally:
+        await abot.delete_message(message.chat.id, loading_msg.message_id)
+
+@abot.chat_member_handler(func=lambda update: bool(config.REQUIRED_CHANNEL_ID) and is_required_channel(update.chat))
+@metrics.handler('chat_member')
+async def handle_chat_member(update):
+    member = update.new_chat_member
+    membership_cache.update(member.user.id, member.status)
+
+@abot.inline_handler(func=lambda query: gif_index is not None)
+@metrics.handler('inline')
+async def handle_inline(query):
+    if not await check_subscription(query.from_user.id):
+        await abot.answer_inline_query(query.id, [], cache_time=0, is_personal=True, button=subscribe_button())
+        return
+    offset = int(query.offset) if query.offset.isdigit() else 0
+    results, next_offset = inline_results(query.query.strip(), offset)
+    # shared answers would reach users who are not subscribed, so they are cached per user while the gate is on
+    await abot.answer_inline_query(
+        query.id, results, cache_time=config.INLINE_CACHE_TIME, is_personal=bool(config.REQUIRED_CHANNEL_ID), next_offset=next_offset)
+
+@abot.callback_query_handler(func=lambda call: True)
+@metrics.handler('callback')
+async def handle_callback(call):
+    user_id = call.from_user.id
+    state = user_states.get(user_id)
+    if state is None:
+        await abot.answer_callback_query(call.id, lang["alert_session_expired"], show_alert=True)
+        return
+
+    data = call.data
+    chat_id = call.message.chat.id
+
+    view = settings_view(data, state, user_id)
+    if view:
+        caption, keyboard, parse_mode = view
+        await abot.edit_message_caption(caption=caption, chat_id=chat_id, message_id=call.message.message_id, reply_markup=keyboard, parse_mode=parse_mode)
+        await abot.answer_callback_query(call.id, lang["setting_changed"] if data.startswith("set_") else None)
+        return
+
+    prompts = {
+        "start_": ('start_time', lang["prompt_start_time"]),
+        "end_": ('end_time', lang["prompt_end_time"]),
+        "duration_": ('duration', lang["prompt_duration"].format(max_duration=config.MAX_GIF_DURATION)),
+    }
+    for prefix, (waiting_for, prompt) in prompts.items():
+        if data.startswith(prefix):
+            state['waiting_for'] = waiting_for
+            prompt_msg = await abot.send_message(chat_id, prompt)
+            state['prompt_message_id'] = prompt_msg.message_id
+            user_states.save(user_id, state)
+            return
+
+    if data == "cancel":
+        await abot.delete_message(chat_id, call.message.message_id)
+        del user_states[user_id]
+        await abot.answer_callback_query(call.id)
+        return
+
+    if data == "add_clip":
+        alert, added = add_clip(state)
+        if added:
+            user_states.save(user_id, state)
+            await abot.edit_message_reply_markup(chat_id, call.message.message_id, reply_markup=session_keyboard(state))
+        await abot.answer_callback_query(call.id, alert, show_alert=not added)
+        return
+
+    if data not in ("preview", "done"):
+        await abot.answer_callback_query(call.id)
+        return
+
+    alert = range_alert(state)
+    if alert:
+        await abot.answer_callback_query(call.id, alert, show_alert=True)
+        return
+    clips = batch_clips(state) if data == "done" else []
+    if len(clips) > config.BATCH_MAX_CLIPS:
+        await abot.answer_callback_query(call.id, lang["alert_batch_full"].format(max_clips=config.BATCH_MAX_CLIPS), show_alert=True)
+        return
+
+    if data == "preview":
+        caption = lang["preview_ready"].format(start_time=state['start_time'], end_time=state['end_time'])
+        if await send_cached(chat_id, preview_cache, preview_cache_key(state), caption):
+            await abot.answer_callback_query(call.id)
+            return
+    elif len(clips) < 2 and await send_cached(chat_id, gif_cache, gif_cache_key(state), lang["gif_ready"].format(title=state['title'])):
+        await abot.answer_callback_query(call.id)
+        logging.info(f"User {user_id}: Served GIF from cache")
+        try: await abot.delete_message(chat_id, state['message_id'])
+        except Exception: pass
+        del user_states[user_id]
+        return
+
+    alert = queue_alert(user_id)
+    if alert:
+        await abot.answer_callback_query(call.id, alert, show_alert=True)
+        return
+    await abot.answer_callback_query(call.id)
+
+    if data == "preview":
+        process_msg = await abot.send_message(chat_id, lang["creating_preview"].format(start_time=state['start_time'], end_time=state['end_time']))
+        job = build_job(user_id, chat_id, state, process_msg.message_id, kind='preview')
+        await submit_job(job, finish_preview, fail_preview)
+        return
+
+    try: await abot.delete_message(chat_id, state['message_id'])
+    except Exception: pass
+    if len(clips) > 1:
+        process_msg = await abot.send_message(chat_id, lang["creating_batch"].format(count=len(clips)))
+        job = build_job(user_id, chat_id, state, process_msg.message_id, kind='batch')
+        del user_states[user_id]
+        await submit_job(job, finish_batch, fail_render)
+        return
+    process_msg = await abot.send_message(chat_id, lang["creating_gif"].format(start_time=state['start_time'], end_time=state['end_time']))
+    job = build_job(user_id, chat_id, state, process_msg.message_id)
+    del user_states[user_id]
+    await submit_job(job, finish_render, fail_render)
+
+async def main():
+    global http, host, loop
+    loop = asyncio.get_running_loop()
+    http = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=config.HTTP_POOL_SIZE),
+        timeout=aiohttp.ClientTimeout(total=60))
+    host = AsyncHostClient(http, config.YT_DLP_HOST_URL, client.headers)
+    gif_cache.invalidate(ENCODER_VERSION)
+    scratch.get_space().sweep()
+    metrics.SCRATCH_BYTES.set_function(lambda: scratch.get_space().usage())
+    export_cache_stats()
+    if config.RENDER_BACKEND == "sqlite":
+        render_queue.callbacks_for = job_callbacks
+    render_queue.start()
+    user_states.start_sweeper(config.SESSION_SWEEP_INTERVAL)
+    if config.REQUIRED_CHANNEL_ID:
+        asyncio.create_task(refresh_subscriptions())
+    if config.METRICS_PORT:
+        metrics.start_server(config.METRICS_HOST, config.METRICS_PORT)
+    try:
+        await abot.infinity_polling(timeout=10, allowed_updates=util.update_types)
+    finally:
+        user_states.flush()
+        await http.close()
+
+if __name__ == '__main__':
+    logging.info("Async bot is starting...")
+    asyncio.run(main())
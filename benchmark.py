@@ -0,0 +1,249 @@
+import argparse
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import re
+import resource
+import shutil
+import statistics
+import subprocess
+import threading
+import time
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import config
+import render
+from utils import seconds_to_time
+
+# name -> (lavfi source, amount of motion)
+SOURCES = {
+    'testsrc': ('testsrc=size={size}:rate=30', 'low'),
+    'testsrc2': ('testsrc2=size={size}:rate=30', 'medium'),
+    'mandelbrot': ('mandelbrot=size={size}:rate=30', 'high'),
+}
+RESOLUTIONS = ['640x360', '1280x720', '1920x1080']
+
+
+class FakeTaskResult:
+    def __init__(self, file_url):
+        self.file_url = file_url
+
+    def get_file_url(self):
+        return self.file_url
+
+
+class FakeClient:
+    # stands in for the yt-dlp-host client, every clip is served whole from a local HTTP server
+    headers = {}
+
+    def __init__(self, base_url, clips):
+        self.base_url = base_url
+        self.clips = clips
+
+    def get_video(self, url, video_format, audio_format, output_format, start_time, end_time, force_keyframes=False):
+        name, duration = self.clips[url]
+        if (start_time, end_time) != ('00:00:00', seconds_to_time(duration)):
+            raise ValueError(f"Benchmark clips are only served whole, got {start_time}-{end_time}")
+        return FakeTaskResult(f"{self.base_url}/{name}.{output_format}")
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def tool_version(command):
+    try:
+        return subprocess.run(command, capture_output=True, text=True).stdout.splitlines()[0]
+    except (OSError, IndexError):
+        return None
+
+def generate_clip(work_dir, source, resolution, duration):
+    name = f"{source}_{resolution}_{duration}s"
+    mp4_path = os.path.join(work_dir, f"{name}.mp4")
+    if not os.path.exists(mp4_path):
+        logging.info(f"Generating {name}")
+        lavfi = SOURCES[source][0].format(size=resolution)
+        tmp_path = mp4_path + '.part'
+        subprocess.run([
+            'ffmpeg', '-loglevel', 'error', '-f', 'lavfi', '-i', lavfi, '-t', str(duration),
+            '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '18', '-g', '30', '-pix_fmt', 'yuv420p',
+            '-bitexact', '-f', 'mp4', '-y', tmp_path
+        ], check=True)
+        os.replace(tmp_path, mp4_path)
+    mkv_path = os.path.join(work_dir, f"{name}.mkv")
+    if not os.path.exists(mkv_path):
+        subprocess.run(['ffmpeg', '-loglevel', 'error', '-i', mp4_path, '-c', 'copy', '-f', 'matroska', '-y', mkv_path], check=True)
+    return name
+
+def start_server(work_dir):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(QuietHandler, directory=work_dir))
+    threading.Thread(target=server.serve_forever, name='bench-http', daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+def run_case(job, base_url, clips, output_path):
+    # runs in a fresh process so peak RSS belongs to this case only
+    config.SOURCE_CACHE_DIR = None
+    config.PALETTE_CACHE_DIR = None
+    config.ENCODE_STATS_PATH = None
+    render._client = FakeClient(base_url, clips)
+
+    self_before = resource.getrusage(resource.RUSAGE_SELF)
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    started = time.perf_counter()
+    output, applied = render.render(job)
+    wall = time.perf_counter() - started
+    self_after = resource.getrusage(resource.RUSAGE_SELF)
+    children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    if isinstance(output, bytes):
+        with open(output_path, 'wb') as f:
+            f.write(output)
+    else:
+        shutil.move(output, output_path)
+    cpu = sum(
+        getattr(after, field) - getattr(before, field)
+        for before, after in ((self_before, self_after), (children_before, children_after))
+        for field in ('ru_utime', 'ru_stime'))
+    return {
+        'applied': applied,
+        'wall_seconds': wall,
+        'cpu_seconds': cpu,
+        'peak_rss_kb': max(self_after.ru_maxrss, children_after.ru_maxrss),
+        'bytes': os.path.getsize(output_path),
+    }
+
+def measure_quality(output_path, reference_path, fps):
+    # the reference is resampled to the output frame rate and size before comparing
+    graph = (
+        f'[1:v]fps={fps},format=yuv420p[r];[0:v]format=yuv420p[o];'
+        '[r][o]scale2ref=flags=bicubic[ref][out];'
+        '[out]split[o1][o2];[ref]split[r1][r2];[o1][r1]ssim;[o2][r2]psnr'
+    )
+    result = subprocess.run([
+        'ffmpeg', '-hide_banner', '-nostats', '-i', output_path, '-i', reference_path,
+        '-lavfi', graph, '-f', 'null', '-'
+    ], capture_output=True, text=True, check=True)
+    ssim = re.search(r'SSIM .*All:([\d.]+)', result.stderr)
+    psnr = re.search(r'PSNR .*average:([\d.]+|inf)', result.stderr)
+    return (
+        float(ssim.group(1)) if ssim else None,
+        float(psnr.group(1)) if psnr and psnr.group(1) != 'inf' else None,
+    )
+
+def build_cases(args):
+    for source, resolution, fps, width, colors in itertools.product(
+            args.sources, args.resolutions, args.fps, args.widths, args.colors):
+        yield {'source': source, 'resolution': resolution, 'fps': fps, 'width': width, 'colors': colors}
+
+def run_benchmark(args):
+    os.makedirs(args.work_dir, exist_ok=True)
+    output_dir = os.path.join(args.work_dir, 'output')
+    os.makedirs(output_dir, exist_ok=True)
+
+    clips = {}
+    for source, resolution in itertools.product(args.sources, args.resolutions):
+        name = generate_clip(args.work_dir, source, resolution, args.duration)
+        clips[f"https://www.youtube.com/watch?v={name}"] = (name, args.duration)
+
+    server, base_url = start_server(args.work_dir)
+    context = multiprocessing.get_context('spawn')
+    results = []
+    try:
+        with context.Pool(processes=1, maxtasksperchild=1) as pool:
+            cases = list(build_cases(args))
+            for index, case in enumerate(cases, 1):
+                name = f"{case['source']}_{case['resolution']}_{args.duration}s"
+                job = {
+                    'user_id': 0, 'url': f"https://www.youtube.com/watch?v={name}", 'title': name,
+                    'start_time': '00:00:00', 'end_time': seconds_to_time(args.duration),
+                    'video_width': int(case['resolution'].split('x')[0]),
+                    'gif_settings': {'fps': case['fps'], 'width': case['width'], 'colors': case['colors'], 'format': args.format},
+                }
+                output_path = os.path.join(
+                    output_dir, f"{name}_{case['fps']}fps_{case['width']}w_{case['colors']}c.{args.format}")
+                runs = [pool.apply(run_case, (job, base_url, clips, output_path)) for _ in range(args.repeat)]
+                ssim, psnr = measure_quality(output_path, os.path.join(args.work_dir, f"{name}.mp4"), runs[-1]['applied']['fps'])
+                result = {
+                    **case, 'motion': SOURCES[case['source']][1], 'format': args.format,
+                    'applied': runs[-1]['applied'],
+                    'wall_seconds': round(statistics.median(run['wall_seconds'] for run in runs), 3),
+                    'cpu_seconds': round(statistics.median(run['cpu_seconds'] for run in runs), 3),
+                    'peak_rss_kb': max(run['peak_rss_kb'] for run in runs),
+                    'bytes': runs[-1]['bytes'],
+                    'ssim': ssim, 'psnr': psnr,
+                }
+                results.append(result)
+                print(f"[{index}/{len(cases)}] {name} {case['fps']}fps {case['width']}w {case['colors']}c: "
+                      f"{result['wall_seconds']}s wall, {result['cpu_seconds']}s cpu, {result['peak_rss_kb']} KiB, "
+                      f"{result['bytes']} bytes, SSIM {ssim}, PSNR {psnr}")
+    finally:
+        server.shutdown()
+
+    return {
+        'meta': {
+            'time': time.time(),
+            'encoder_version': render.ENCODER_VERSION,
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'cpu_count': os.cpu_count(),
+            'ffmpeg': tool_version(['ffmpeg', '-version']),
+            'gifsicle': tool_version(['gifsicle', '--version']),
+            'duration': args.duration,
+            'repeat': args.repeat,
+            'stream_encoding': render.streaming(),
+            'target_size_encoding': config.TARGET_SIZE_ENCODING,
+            'palette_engine': config.PALETTE_ENGINE,
+            'palette_per_scene': config.PALETTE_PER_SCENE,
+            'segment_encoding': config.SEGMENT_ENCODING,
+            'segment_seconds': config.SEGMENT_SECONDS,
+        },
+        'results': results,
+    }
+
+def case_key(result):
+    return (result['source'], result['resolution'], result['fps'], result['width'], result['colors'], result['format'])
+
+def compare(baseline, current):
+    previous = {case_key(result): result for result in baseline['results']}
+    print(f"Encoder {baseline['meta']['encoder_version']} -> {current['meta']['encoder_version']}")
+    for result in current['results']:
+        old = previous.get(case_key(result))
+        if not old:
+            continue
+        ratios = ', '.join(
+            f"{field} x{result[field] / old[field]:.2f}"
+            for field in ('wall_seconds', 'cpu_seconds', 'peak_rss_kb', 'bytes') if old[field])
+        quality = f"SSIM {old['ssim']} -> {result['ssim']}, PSNR {old['psnr']} -> {result['psnr']}"
+        print(f"{' '.join(map(str, case_key(result)))}: {ratios}, {quality}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the GIF encoding pipeline on synthetic local video")
+    parser.add_argument('--sources', nargs='+', choices=list(SOURCES), default=list(SOURCES))
+    parser.add_argument('--resolutions', nargs='+', default=RESOLUTIONS)
+    parser.add_argument('--fps', nargs='+', type=int, default=render.FPS_OPTIONS)
+    parser.add_argument('--widths', nargs='+', type=int, default=render.WIDTH_OPTIONS)
+    parser.add_argument('--colors', nargs='+', type=int, default=render.COLOR_OPTIONS)
+    parser.add_argument('--format', choices=render.FORMAT_OPTIONS, default='gif')
+    parser.add_argument('--duration', type=int, default=5, help="clip length in seconds")
+    parser.add_argument('--repeat', type=int, default=1, help="runs per case, times are the median")
+    parser.add_argument('--work-dir', default='bench_work', help="generated clips and rendered outputs")
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', metavar='BASELINE', help="results file of an earlier run to compare against")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    report = run_benchmark(args)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,32 @@
 import telebot
-from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
+from telebot import util, apihelper
+from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, InputMediaDocument, InputMediaVideo
+from telebot.types import InlineQueryResultCachedGif, InlineQueryResultCachedMpeg4Gif, InlineQueryResultsButton
 import yt_dlp_host_api
 import config
 import os
-import tempfile
 import requests
 from io import BytesIO
 from locales import TRANSLATIONS
 import time
-from urllib.parse import urlparse
+import threading
+from utils import is_youtube_url, extract_video_id, time_to_seconds, seconds_to_time, normalize_time, parse_time_range
 import logging
-import subprocess
+import re
+from render_queue import RenderQueue, QueueFull, UserLimitReached
+from job_queue import JobStore, DistributedRenderQueue
+from render import ENCODER_VERSION, OutputTooLarge, effective_width, result_size, FPS_OPTIONS, WIDTH_OPTIONS, COLOR_OPTIONS, FORMAT_OPTIONS
+from gif_cache import GifCache
+from gif_index import GifIndex
+from cache import TTLCache, CoalescingCache, MembershipCache
+from session_store import create_session_store
+import atexit
+import metrics
+import load_policy
+import scratch
+import json
+import hashlib
+from telegram_scheduler import TelegramScheduler
 
 logging.basicConfig(
     level=logging.INFO,
@@ -23,62 +39,93 @@ logging.basicConfig(
 
 
 bot = telebot.TeleBot(config.TELEGRAM_BOT_TOKEN)
+
+def timed_request(method, url, **kwargs):
+    with metrics.telegram_call(url.rsplit('/', 1)[-1]):
+        return apihelper._get_req_session().request(method, url, **kwargs)
+
+# every Bot API call is rate limited, coalesced and retried on flood limits before timed_request sends it
+telegram_scheduler = TelegramScheduler(
+    timed_request, config.TELEGRAM_GLOBAL_RATE, config.TELEGRAM_PRIVATE_CHAT_RATE, config.TELEGRAM_GROUP_CHAT_RATE,
+    config.TELEGRAM_CHAT_BURST, config.TELEGRAM_MAX_RETRIES)
+apihelper.CUSTOM_REQUEST_SENDER = telegram_scheduler.request
 api = yt_dlp_host_api.api(config.YT_DLP_HOST_URL)
 client = api.get_client(config.YT_DLP_API_KEY)
 lang = TRANSLATIONS[config.BOT_LANGUAGE]
-user_states = {}
+user_states = create_session_store(
+    config.SESSION_BACKEND, config.SESSION_MAX_ENTRIES, config.SESSION_TTL,
+    path=config.SESSION_DB_PATH, flush_interval=config.SESSION_FLUSH_INTERVAL)
+if config.RENDER_BACKEND == "sqlite":
+    render_queue = DistributedRenderQueue(
+        JobStore(config.JOB_DB_PATH, config.JOB_LEASE_SECONDS, config.JOB_MAX_ATTEMPTS, config.JOB_DB_WAL),
+        config.JOB_SPOOL_DIR, config.RENDER_QUEUE_LIMIT, config.RENDER_USER_LIMIT, config.JOB_POLL_INTERVAL)
+else:
+    render_queue = RenderQueue(config.RENDER_WORKERS, config.RENDER_QUEUE_LIMIT, config.RENDER_USER_LIMIT, load_policy.apply)
+info_cache = CoalescingCache(config.INFO_CACHE_MAX_ENTRIES, config.INFO_CACHE_TTL)
+preview_cache = TTLCache(config.PREVIEW_CACHE_MAX_ENTRIES, config.PREVIEW_CACHE_TTL)
+gif_cache = GifCache(config.GIF_CACHE_PATH, config.GIF_CACHE_MAX_ENTRIES, config.GIF_CACHE_TTL)
+gif_index = GifIndex(config.GIF_INDEX_PATH, config.GIF_INDEX_MAX_ENTRIES) if config.GIF_INDEX_PATH else None
+inline_cache = TTLCache(config.INLINE_CACHE_MAX_ENTRIES, config.INLINE_CACHE_TIME)
+membership_cache = MembershipCache(
+    config.SUBSCRIPTION_CACHE_MAX_ENTRIES, config.SUBSCRIPTION_POSITIVE_TTL, config.SUBSCRIPTION_NEGATIVE_TTL)
 
-FPS_OPTIONS = [10, 15, 20, 25]
-WIDTH_OPTIONS = [360, 480, 720, 1080]
-COLOR_OPTIONS = [64, 128, 256]
+def export_cache_stats():
+    caches = {'info': info_cache, 'preview': preview_cache, 'gif': gif_cache, 'inline': inline_cache, 'membership': membership_cache}
+    def lookups():
+        values = {}
+        for name, cache in caches.items():
+            stats = cache.stats()
+            values[(name, 'hit')], values[(name, 'miss')] = stats['hits'], stats['misses']
+        return values
+    metrics.CACHE_LOOKUPS.set_function(lookups)
+    metrics.CACHE_ENTRIES.set_function(lambda: {name: cache.stats()['size'] for name, cache in caches.items()})
+
+SETTING_OPTIONS = {
+    'fps': FPS_OPTIONS,
+    'width': WIDTH_OPTIONS,
+    'colors': COLOR_OPTIONS,
+    'format': FORMAT_OPTIONS
+}
 
 DEFAULT_SETTINGS = {
     'fps': 15,
     'width': 480,
-    'colors': 128
+    'colors': 128,
+    'format': 'gif'
 }
 
 def is_current(a, b):
     return str(a) == str(b)
 
-def is_youtube_url(url):
-    try:
-        parsed_url = urlparse(url)
-        return (parsed_url.scheme in ['http', 'https'] and
-                parsed_url.netloc in {
-                    "youtube.com", "www.youtube.com", "m.youtube.com",
-                    "youtu.be", "youtube-nocookie.com"
-                })
-    except Exception:
-        return False
-
-def time_to_seconds(time_str):
-    try:
-        parts = time_str.split(':')
-        h, m, s = (0, 0, 0)
-        if len(parts) == 3: h, m, s = map(int, parts)
-        elif len(parts) == 2: m, s = map(int, parts)
-        else: s = int(parts[0])
-        return h * 3600 + m * 60 + s
-    except:
-        return 0
-
-def seconds_to_time(seconds):
-    hours = int(seconds // 3600)
-    minutes = int((seconds % 3600) // 60)
-    secs = int(seconds % 60)
-    return f"{hours:02d}:{minutes:02d}:{secs:02d}"
+def is_required_channel(chat):
+    return is_current(chat.id, config.REQUIRED_CHANNEL_ID) or (
+        chat.username is not None and f"@{chat.username}".lower() == str(config.REQUIRED_CHANNEL_ID).lower())
 
 def check_subscription(user_id):
     if not config.REQUIRED_CHANNEL_ID: return True
+    is_member = membership_cache.lookup(user_id)
+    if is_member is not None:
+        return is_member
+    return refresh_subscription(user_id)
+
+def refresh_subscription(user_id):
     try:
         member = bot.get_chat_member(config.REQUIRED_CHANNEL_ID, user_id)
-        return member.status in ['member', 'administrator', 'creator']
     except Exception as e:
         logging.warning(f"Could not check subscription for {user_id}: {e}")
         return False
+    return membership_cache.update(user_id, member.status)
 
-def create_time_keyboard(start_time, end_time):
+def start_subscription_refresher():
+    def refresh_loop():
+        while True:
+            time.sleep(config.SUBSCRIPTION_REFRESH_INTERVAL)
+            for user_id in membership_cache.take_stale(config.SUBSCRIPTION_REFRESH_BATCH):
+                refresh_subscription(user_id)
+    if config.REQUIRED_CHANNEL_ID:
+        threading.Thread(target=refresh_loop, name='subscription-refresh', daemon=True).start()
+
+def create_time_keyboard(start_time, end_time, clip_count=0):
     keyboard = InlineKeyboardMarkup(row_width=2)
     duration_seconds = time_to_seconds(end_time) - time_to_seconds(start_time)
     
@@ -86,12 +133,17 @@ def create_time_keyboard(start_time, end_time):
     end_btn = InlineKeyboardButton(lang["button_end"].format(time=end_time), callback_data=f"end_{end_time}")
     duration_btn = InlineKeyboardButton(lang["button_duration"].format(seconds=duration_seconds), callback_data=f"duration_{duration_seconds}")
     settings_btn = InlineKeyboardButton(lang["button_settings"], callback_data="open_settings_main")
+    preview_btn = InlineKeyboardButton(lang["button_preview"], callback_data="preview")
+    add_clip_btn = InlineKeyboardButton(lang["button_add_clip"].format(count=clip_count), callback_data="add_clip")
     done_btn = InlineKeyboardButton(lang["button_done"], callback_data="done")
     cancel_btn = InlineKeyboardButton(lang["button_cancel"], callback_data="cancel")
     
-    keyboard.add(start_btn, end_btn, duration_btn, settings_btn, done_btn, cancel_btn)
+    keyboard.add(start_btn, end_btn, duration_btn, settings_btn, preview_btn, add_clip_btn, done_btn, cancel_btn)
     return keyboard
 
+def session_keyboard(state):
+    return create_time_keyboard(state['start_time'], state['end_time'], len(state.get('clips') or ()))
+
 def create_main_settings_keyboard(user_id):
     settings = user_states[user_id]['gif_settings']
     keyboard = InlineKeyboardMarkup(row_width=1)
@@ -99,23 +151,400 @@ def create_main_settings_keyboard(user_id):
     fps_btn = InlineKeyboardButton(lang["setting_fps"].format(value=settings['fps']), callback_data="open_settings_fps")
     width_btn = InlineKeyboardButton(lang["setting_width"].format(value=settings['width']), callback_data="open_settings_width")
     colors_btn = InlineKeyboardButton(lang["setting_colors"].format(value=settings['colors']), callback_data="open_settings_colors")
+    format_btn = InlineKeyboardButton(lang["setting_format"].format(value=settings['format'].upper()), callback_data="open_settings_format")
     back_btn = InlineKeyboardButton(lang["button_back"], callback_data="back_to_main")
     
-    keyboard.add(fps_btn, width_btn, colors_btn, back_btn)
+    keyboard.add(fps_btn, width_btn, colors_btn, format_btn, back_btn)
     return keyboard
 
 def create_specific_setting_keyboard(setting_type, current_value, options):
     keyboard = InlineKeyboardMarkup(row_width=4)
     buttons = []
     for option in options:
-        text = f"✅ {option}" if is_current(option, current_value) else str(option)
+        label = str(option).upper()
+        text = f"✅ {label}" if is_current(option, current_value) else label
         buttons.append(InlineKeyboardButton(text, callback_data=f"set_{setting_type}_{option}"))
     
     keyboard.add(*buttons)
     keyboard.row(InlineKeyboardButton(lang["button_back_to_settings"], callback_data="open_settings_main"))
     return keyboard
 
+def render_progress_text(job, stage, position):
+    header = {'preview': "creating_preview", 'batch': "creating_batch"}.get(job.get('kind'), "creating_gif")
+    text = lang[header].format(start_time=job['start_time'], end_time=job['end_time'], count=len(job.get('clips') or ()))
+    if stage == 'queued':
+        return text + "\n\n" + lang["progress_queued"].format(position=position)
+    return text + "\n\n" + lang[f"progress_{stage}"]
+
+def update_render_progress(job, stage, position):
+    bot.edit_message_text(render_progress_text(job, stage, position), job['chat_id'], job['process_message_id'])
+
+def new_session(url, video_data, clips=None):
+    title = video_data.get('title', lang["video_title_default"])
+    duration = video_data.get('duration', 0)
+    duration_str = seconds_to_time(duration)
+    start_time = "00:00:00"
+    end_time = seconds_to_time(min(16, duration))
+    session = {
+        'url': url, 'title': title, 'duration': duration_str,
+        'start_time': start_time, 'end_time': end_time,
+        'gif_settings': DEFAULT_SETTINGS.copy(),
+        'video_width': video_data.get('width', 0)
+    }
+    if clips:
+        session['clips'] = [[seconds_to_time(start), seconds_to_time(end)] for start, end in clips]
+        session['start_time'], session['end_time'] = session['clips'][-1]
+    caption = lang["video_caption"].format(title=title, duration=duration_str)
+    return session, caption, session_keyboard(session)
+
+def parse_batch(text):
+    parts = (text or '').strip().split(None, 1)
+    url = parts[0] if parts else ''
+    ranges = [line for line in re.split(r'[\n,;]+', parts[1]) if line.strip()] if len(parts) > 1 else []
+    clips = [parse_time_range(line) for line in ranges]
+    return url, None if None in clips else clips
+
+def clips_fit(clips, duration):
+    return len(clips) <= config.BATCH_MAX_CLIPS and all(
+        0 <= start < end <= duration and end - start <= config.MAX_GIF_DURATION for start, end in clips)
+
+def batch_ranges_error():
+    return lang["error_batch_ranges"].format(max_clips=config.BATCH_MAX_CLIPS, max_duration=config.MAX_GIF_DURATION)
+
+def batch_clips(state):
+    # the range on screen is part of the batch too, a single clip is rendered as a normal GIF
+    clips = list(state.get('clips') or [])
+    current = [state['start_time'], state['end_time']]
+    if clips and current not in clips:
+        clips.append(current)
+    return clips
+
+def add_clip(state):
+    alert = range_alert(state)
+    if alert:
+        return alert, False
+    clips = state.get('clips') or []
+    current = [state['start_time'], state['end_time']]
+    if current in clips:
+        return lang["alert_clip_exists"], False
+    if len(clips) >= config.BATCH_MAX_CLIPS:
+        return lang["alert_batch_full"].format(max_clips=config.BATCH_MAX_CLIPS), False
+    state['clips'] = clips + [current]
+    return lang["clip_added"].format(count=len(state['clips'])), True
+
+def fetch_video_info(url):
+    with metrics.stage('get_info'):
+        info = client.get_info(url=url)
+        video_data = info.get_json(['title', 'duration', 'thumbnail', 'width'])
+    thumbnail_bytes = None
+    thumbnail = video_data.get('thumbnail', '')
+    if thumbnail:
+        try:
+            with metrics.stage('thumbnail'):
+                response = requests.get(thumbnail, timeout=10)
+                response.raise_for_status()
+                thumbnail_bytes = response.content
+        except Exception as e:
+            logging.warning(f"Could not fetch thumbnail {thumbnail}: {e}")
+    return video_data, thumbnail_bytes
+
+def get_video_info(url):
+    return info_cache.get_or_fetch(extract_video_id(url), lambda: fetch_video_info(url))
+
+def gif_cache_key(state):
+    settings = state['gif_settings']
+    return GifCache.make_key(
+        extract_video_id(state['url']), normalize_time(state['start_time']), normalize_time(state['end_time']),
+        settings['fps'], effective_width(settings, state.get('video_width')), settings['colors'],
+        settings['format'], ENCODER_VERSION)
+
+def send_cached_gif(chat_id, state):
+    key = gif_cache_key(state)
+    file_id = gif_cache.get(key)
+    if not file_id:
+        return False
+    try:
+        bot.send_animation(chat_id, file_id, caption=lang["gif_ready"].format(title=state['title']))
+        if gif_index: gif_index.used(file_id)
+        return True
+    except Exception as e:
+        logging.warning(f"Cached GIF {key} could not be sent, dropping it: {e}")
+        gif_cache.discard(key)
+        if gif_index: gif_index.discard(file_id)
+        return False
+
+def open_gif(gif, name='animation.gif'):
+    if isinstance(gif, bytes):
+        buffer = BytesIO(gif)
+        buffer.name = name
+        return buffer
+    return open(gif, 'rb')
+
+def load_note(job):
+    if not job.get('downgraded'):
+        return ""
+    settings = job['gif_settings']
+    return "\n" + lang["settings_reduced_load"].format(
+        fps=settings['fps'], width=effective_width(settings, job.get('video_width')), colors=settings['colors'])
+
+def render_caption(job, applied):
+    caption = lang["gif_ready"].format(title=job['title']) + load_note(job)
+    settings = job['gif_settings']
+    if any(applied.get(key) != settings[key] for key in ('fps', 'colors')) or applied.get('width') != effective_width(settings, job.get('video_width')):
+        caption += "\n" + lang["settings_applied"].format(fps=applied['fps'], width=applied['width'], colors=applied['colors'])
+    return caption
+
+def finish_render(job, result):
+    gif, applied = result
+    try:
+        update_render_progress(job, 'uploading', 0)
+    except Exception: pass
+    try:
+        with open_gif(gif) as f, metrics.stage('send_animation', job['timings']):
+            sent = bot.send_animation(job['chat_id'], f, caption=render_caption(job, applied))
+        media = sent.animation or sent.document
+        # a result lowered because of load must not be served for the full-quality settings
+        if media and not job.get('downgraded'):
+            gif_cache.put(job['cache_key'], ENCODER_VERSION, media.file_id)
+        index_result(job, sent.animation, applied)
+        bot.delete_message(job['chat_id'], job['process_message_id'])
+        metrics.log_job(job, 'done', result_size(gif))
+    except Exception as e:
+        fail_render(job, e)
+    finally:
+        if isinstance(gif, str) and os.path.exists(gif): os.unlink(gif)
+
+def index_result(job, animation, applied):
+    # only animations can be answered to inline queries, GIFs Telegram kept as documents are left out
+    if gif_index and animation:
+        gif_index.add(
+            animation.file_id, job['title'], extract_video_id(job['url']),
+            normalize_time(job['start_time']), normalize_time(job['end_time']),
+            applied['fps'], applied['width'], applied['colors'], job['gif_settings'].get('format', 'gif'))
+
+def inline_result(entry):
+    result_type = InlineQueryResultCachedMpeg4Gif if entry['format'] == 'mp4' else InlineQueryResultCachedGif
+    return result_type(
+        hashlib.sha1(entry['file_id'].encode()).hexdigest()[:32], entry['file_id'],
+        title=entry['title'], caption=lang["inline_caption"].format(title=entry['title']),
+        description=lang["inline_description"].format(
+            start_time=entry['start_time'], end_time=entry['end_time'], fps=entry['fps'], width=entry['width']))
+
+def inline_results(text, offset):
+    # a page of results for an inline query, and the offset of the next page ('' on the last one)
+    key = (text, offset)
+    answer = inline_cache.get(key)
+    if answer is None:
+        video_id = extract_video_id(text) if is_youtube_url(text) else None
+        entries, more = gif_index.search(text, video_id, offset, config.INLINE_PAGE_SIZE)
+        answer = ([inline_result(entry) for entry in entries], str(offset + len(entries)) if more else '')
+        inline_cache.put(key, answer)
+    return answer
+
+def subscribe_button():
+    return InlineQueryResultsButton(text=lang["inline_subscribe"], start_parameter="subscribe")
+
+def batch_media(job, files):
+    caption = lang["batch_ready"].format(count=len(files), title=job['title']) + load_note(job)
+    # media groups cannot contain animations, GIFs are sent as documents so they stay GIFs
+    media_type = InputMediaVideo if job['gif_settings'].get('format') == 'mp4' else InputMediaDocument
+    return [media_type(f, caption=caption if index == 0 else None) for index, f in enumerate(files)]
+
+def finish_batch(job, result):
+    outputs, _ = result
+    files = []
+    try:
+        try:
+            update_render_progress(job, 'uploading', 0)
+        except Exception: pass
+        files = [open_gif(output, f'clip_{index}.gif') for index, output in enumerate(outputs, 1)]
+        with metrics.stage('send_animation', job['timings']):
+            bot.send_media_group(job['chat_id'], batch_media(job, files))
+        bot.delete_message(job['chat_id'], job['process_message_id'])
+        metrics.log_job(job, 'done', sum(result_size(output) for output in outputs))
+    except Exception as e:
+        fail_render(job, e)
+    finally:
+        for f in files: f.close()
+        for output in outputs:
+            if isinstance(output, str) and os.path.exists(output): os.unlink(output)
+
+def preview_cache_key(state):
+    # a string so that jobs carrying it survive the JSON round trip through the job queue
+    return f"{extract_video_id(state['url'])}|{normalize_time(state['start_time'])}|{normalize_time(state['end_time'])}"
+
+def send_cached_preview(chat_id, state):
+    key = preview_cache_key(state)
+    file_id = preview_cache.get(key)
+    if not file_id:
+        return False
+    try:
+        bot.send_animation(chat_id, file_id, caption=lang["preview_ready"].format(start_time=state['start_time'], end_time=state['end_time']))
+        return True
+    except Exception as e:
+        logging.warning(f"Cached preview {key} could not be sent, dropping it: {e}")
+        preview_cache.discard(key)
+        return False
+
+def finish_preview(job, result):
+    gif, _ = result
+    try:
+        with open_gif(gif) as f, metrics.stage('send_animation', job['timings']):
+            sent = bot.send_animation(job['chat_id'], f, caption=lang["preview_ready"].format(start_time=job['start_time'], end_time=job['end_time']))
+        media = sent.animation or sent.document
+        if media:
+            preview_cache.put(job['cache_key'], media.file_id)
+        bot.delete_message(job['chat_id'], job['process_message_id'])
+        metrics.log_job(job, 'done', result_size(gif))
+    except Exception as e:
+        fail_preview(job, e)
+    finally:
+        if isinstance(gif, str) and os.path.exists(gif): os.unlink(gif)
+
+def fail_preview(job, error):
+    logging.error(f"Failed to create preview for user {job['user_id']}. URL: {job['url']}. Error: {error}")
+    metrics.log_job(job, 'error')
+    try: bot.delete_message(job['chat_id'], job['process_message_id'])
+    except Exception: pass
+    bot.send_message(job['chat_id'], lang["error_creating_preview"])
+
+def is_priority(user_id):
+    if user_id in config.PRIORITY_USER_IDS:
+        return True
+    return bool(config.PRIORITY_CHANNEL_ADMINS and config.REQUIRED_CHANNEL_ID) and \
+        membership_cache.status(user_id) in ('administrator', 'creator')
+
+def build_job(user_id, chat_id, state, process_message_id, kind='render'):
+    return {
+        'kind': kind, 'user_id': user_id, 'chat_id': chat_id, 'process_message_id': process_message_id,
+        'priority': is_priority(user_id),
+        'url': state['url'], 'title': state['title'],
+        'start_time': state['start_time'], 'end_time': state['end_time'],
+        'gif_settings': state['gif_settings'].copy(), 'video_width': state.get('video_width'),
+        'clips': batch_clips(state) if kind == 'batch' else None,
+        'cache_key': {'preview': preview_cache_key, 'render': gif_cache_key}.get(kind, lambda state: None)(state)
+    }
+
+def apply_time_input(state, time_type, text):
+    if time_type == 'start_time':
+        time_seconds = time_to_seconds(text)
+        if time_seconds >= time_to_seconds(state['duration']):
+            return False, lang["error_start_too_late"]
+        state['start_time'] = text
+        return True, lang["start_time_set"]
+
+    if time_type == 'end_time':
+        time_seconds = time_to_seconds(text)
+        start_seconds = time_to_seconds(state['start_time'])
+        if time_seconds > time_to_seconds(state['duration']):
+            return False, lang["error_end_too_late"]
+        if time_seconds <= start_seconds:
+            return False, lang["error_end_before_start"]
+        if (time_seconds - start_seconds) > config.MAX_GIF_DURATION:
+            return False, lang["error_duration_too_long"].format(max_duration=config.MAX_GIF_DURATION)
+        state['end_time'] = text
+        return True, lang["end_time_set"]
+
+    try:
+        new_duration = int(text)
+        if new_duration <= 0: raise ValueError
+    except ValueError:
+        return False, lang["error_duration_invalid"]
+    if new_duration > config.MAX_GIF_DURATION:
+        return False, lang["error_duration_too_long"].format(max_duration=config.MAX_GIF_DURATION)
+    start_seconds = time_to_seconds(state['start_time'])
+    new_end_seconds = start_seconds + new_duration
+    if new_end_seconds > time_to_seconds(state['duration']):
+        return False, lang["error_duration_too_long_video"]
+    state['end_time'] = seconds_to_time(new_end_seconds)
+    return True, lang["duration_set"]
+
+def settings_view(data, state, user_id):
+    settings = state['gif_settings']
+    if data == "open_settings_main":
+        return lang["settings_title"], create_main_settings_keyboard(user_id), None
+    if data.startswith("open_settings_"):
+        setting_type = data[len("open_settings_"):]
+        options = SETTING_OPTIONS[setting_type]
+        return lang[f"settings_menu_title_{setting_type}"], create_specific_setting_keyboard(setting_type, settings[setting_type], options), None
+    if data.startswith("set_"):
+        _, setting_type, value = data.split('_')
+        settings[setting_type] = value if setting_type == 'format' else int(value)
+        user_states.save(user_id, state)
+        return lang["settings_title"], create_main_settings_keyboard(user_id), None
+    if data == "back_to_main":
+        caption = lang["video_caption"].format(title=state['title'], duration=state['duration'])
+        return caption, session_keyboard(state), 'Markdown'
+    return None
+
+def delete_messages(chat_id, message_ids):
+    # one deleteMessages call instead of one call per message
+    try:
+        apihelper._make_request(bot.token, 'deleteMessages', method='post', params={'chat_id': chat_id, 'message_ids': json.dumps(message_ids)})
+    except Exception as e:
+        logging.warning(f"Could not delete messages {message_ids} in chat {chat_id}: {e}")
+
+def range_alert(state):
+    start_seconds = time_to_seconds(state['start_time'])
+    end_seconds = time_to_seconds(state['end_time'])
+    if end_seconds <= start_seconds:
+        return lang["alert_end_before_start"]
+    if (end_seconds - start_seconds) > config.MAX_GIF_DURATION:
+        return lang["alert_duration_too_long"].format(max_duration=config.MAX_GIF_DURATION)
+    return None
+
+def queue_alert(user_id):
+    try:
+        render_queue.check(user_id)
+    except UserLimitReached:
+        return lang["alert_render_in_progress"]
+    except QueueFull as e:
+        return lang["alert_queue_full"].format(position=e.position)
+    return None
+
+def check_range(call, state):
+    alert = range_alert(state)
+    if alert:
+        bot.answer_callback_query(call.id, alert, show_alert=True)
+        return False
+    return True
+
+def check_render_queue(call, user_id):
+    alert = queue_alert(user_id)
+    if alert:
+        bot.answer_callback_query(call.id, alert, show_alert=True)
+        return False
+    return True
+
+def submit_job(job, on_done, on_error):
+    try:
+        position = render_queue.submit(job, update_render_progress, on_done, on_error)
+        if position:
+            update_render_progress(job, 'queued', position)
+    except (QueueFull, UserLimitReached):
+        metrics.log_job(job, 'rejected')
+        bot.delete_message(job['chat_id'], job['process_message_id'])
+        bot.send_message(job['chat_id'], lang["error_queue_full"])
+
+def job_callbacks(job):
+    # picks up jobs a previous bot process left in the shared job queue
+    kind = job.get('kind', 'render')
+    on_done, on_error = {'preview': (finish_preview, fail_preview), 'batch': (finish_batch, fail_render)}.get(
+        kind, (finish_render, fail_render))
+    return update_render_progress, on_done, on_error
+
+def fail_render(job, error):
+    logging.error(f"Failed to create GIF for user {job['user_id']}. URL: {job['url']}. Error: {error}")
+    metrics.log_job(job, 'too_large' if isinstance(error, OutputTooLarge) else 'error')
+    try: bot.delete_message(job['chat_id'], job['process_message_id'])
+    except Exception: pass
+    if isinstance(error, OutputTooLarge):
+        bot.send_message(job['chat_id'], lang["error_output_too_large"])
+    else:
+        bot.send_message(job['chat_id'], lang["error_creating_gif"])
+
 @bot.message_handler(commands=['start', 'help'])
+@metrics.handler('start')
 def handle_start(message):
     if not check_subscription(message.from_user.id):
         if config.REQUIRED_CHANNEL_ID:
@@ -124,6 +553,7 @@ def handle_start(message):
     bot.send_message(message.chat.id, lang["start_welcome"].format(max_duration=config.MAX_GIF_DURATION))
 
 @bot.message_handler(func=lambda message: True)
+@metrics.handler('message')
 def handle_message(message):
     user = message.from_user
     user_id = user.id
@@ -134,258 +564,206 @@ def handle_message(message):
             bot.send_message(message.chat.id, lang["subscribe_prompt"].format(channel_id=config.REQUIRED_CHANNEL_ID))
             return
 
-    if user_id in user_states and user_states[user_id].get('waiting_for'):
-        state = user_states[user_id]
+    state = user_states.get(user_id)
+    if state and state.get('waiting_for'):
         time_type = state.get('waiting_for')
         prompt_message_id = state.get('prompt_message_id')
         
         try:
-            confirmation_text = ""
-            if time_type == 'start_time':
-                time_seconds = time_to_seconds(message.text)
-                if time_seconds >= time_to_seconds(state['duration']):
-                    bot.send_message(message.chat.id, lang["error_start_too_late"])
-                    return
-                state['start_time'] = message.text
-                confirmation_text = lang["start_time_set"]
-            
-            elif time_type == 'end_time':
-                time_seconds = time_to_seconds(message.text)
-                start_seconds = time_to_seconds(state['start_time'])
-                if time_seconds > time_to_seconds(state['duration']):
-                    bot.send_message(message.chat.id, lang["error_end_too_late"])
-                    return
-                if time_seconds <= start_seconds:
-                    bot.send_message(message.chat.id, lang["error_end_before_start"])
-                    return
-                if (time_seconds - start_seconds) > config.MAX_GIF_DURATION:
-                    bot.send_message(message.chat.id, lang["error_duration_too_long"].format(max_duration=config.MAX_GIF_DURATION))
-                    return
-                state['end_time'] = message.text
-                confirmation_text = lang["end_time_set"]
-            
-            elif time_type == 'duration':
-                try:
-                    new_duration = int(message.text)
-                    if new_duration <= 0: raise ValueError
-                except ValueError:
-                    bot.send_message(message.chat.id, lang["error_duration_invalid"])
-                    return
-                if new_duration > config.MAX_GIF_DURATION:
-                    bot.send_message(message.chat.id, lang["error_duration_too_long"].format(max_duration=config.MAX_GIF_DURATION))
-                    return
-                start_seconds = time_to_seconds(state['start_time'])
-                new_end_seconds = start_seconds + new_duration
-                if new_end_seconds > time_to_seconds(state['duration']):
-                    bot.send_message(message.chat.id, lang["error_duration_too_long_video"])
-                    return
-                state['end_time'] = seconds_to_time(new_end_seconds)
-                confirmation_text = lang["duration_set"]
+            ok, reply = apply_time_input(state, time_type, message.text)
+            if not ok:
+                bot.send_message(message.chat.id, reply)
+                return
 
             state['waiting_for'] = None
             del state['prompt_message_id']
+            user_states.save(user_id, state)
             
-            confirmation_msg = bot.send_message(message.chat.id, confirmation_text)
+            confirmation_msg = bot.send_message(message.chat.id, reply)
             
-            keyboard = create_time_keyboard(state['start_time'], state['end_time'])
+            keyboard = session_keyboard(state)
             bot.edit_message_reply_markup(message.chat.id, state['message_id'], reply_markup=keyboard)
             
-            time.sleep(1)
-            try:
-                bot.delete_message(message.chat.id, prompt_message_id)
-                bot.delete_message(message.chat.id, message.message_id)
-                bot.delete_message(message.chat.id, confirmation_msg.message_id)
-            except Exception: pass
+            threading.Timer(config.MESSAGE_DELETE_DELAY, delete_messages, args=(
+                message.chat.id, [prompt_message_id, message.message_id, confirmation_msg.message_id])).start()
         except Exception as e:
             logging.error(f"Error processing time input for user {user_id}: {e}")
             bot.send_message(message.chat.id, lang["error_invalid_time_format"])
         return
     
-    if not is_youtube_url(message.text):
+    url, clips = parse_batch(message.text)
+    if not is_youtube_url(url):
         bot.send_message(message.chat.id, lang["error_invalid_url"])
         return
+    if clips is None:
+        bot.send_message(message.chat.id, batch_ranges_error())
+        return
     
-    logging.info(f"User {user_id} ({username}) sent URL: {message.text}")
+    logging.info(f"User {user_id} ({username}) sent URL: {url}" + (f" with {len(clips)} clips" if clips else ""))
     loading_msg = bot.send_message(message.chat.id, lang["getting_info"])
     
     try:
-        info = client.get_info(url=message.text)
-        video_data = info.get_json(['title', 'duration', 'thumbnail', 'width'])
-        
-        title = video_data.get('title', lang["video_title_default"])
-        duration = video_data.get('duration', 0)
-        thumbnail = video_data.get('thumbnail', '')
-        video_width = video_data.get('width', 0)
-        duration_str = seconds_to_time(duration)
-        
-        start_time = "00:00:00"
-        end_time = seconds_to_time(min(16, duration))
-        
-        caption = lang["video_caption"].format(title=title, duration=duration_str)
-        keyboard = create_time_keyboard(start_time, end_time)
+        video_data, thumbnail_bytes = get_video_info(url)
+        if clips and not clips_fit(clips, video_data.get('duration', 0)):
+            bot.send_message(message.chat.id, batch_ranges_error())
+            return
+        session, caption, keyboard = new_session(url, video_data, clips)
         
         msg = None
-        if thumbnail:
+        if thumbnail_bytes:
             try:
-                response = requests.get(thumbnail, timeout=10)
-                photo = BytesIO(response.content)
+                photo = BytesIO(thumbnail_bytes)
                 msg = bot.send_photo(message.chat.id, photo, caption=caption, parse_mode='Markdown', reply_markup=keyboard)
             except Exception: pass
         
         if not msg:
             msg = bot.send_message(message.chat.id, caption, parse_mode='Markdown', reply_markup=keyboard)
         
-        user_states[user_id] = {
-            'url': message.text, 'title': title, 'duration': duration_str,
-            'start_time': start_time, 'end_time': end_time, 'message_id': msg.message_id,
-            'gif_settings': DEFAULT_SETTINGS.copy(),
-            'video_width': video_width
-        }
+        session['message_id'] = msg.message_id
+        user_states[user_id] = session
     except Exception as e:
-        logging.error(f"Failed to get video info for URL {message.text} by user {user_id}. Error: {e}")
+        logging.error(f"Failed to get video info for URL {url} by user {user_id}. Error: {e}")
         bot.send_message(message.chat.id, lang["error_getting_info"])
     finally:
         bot.delete_message(message.chat.id, loading_msg.message_id)
 
+@bot.chat_member_handler(func=lambda update: bool(config.REQUIRED_CHANNEL_ID) and is_required_channel(update.chat))
+@metrics.handler('chat_member')
+def handle_chat_member(update):
+    member = update.new_chat_member
+    membership_cache.update(member.user.id, member.status)
+
+@bot.inline_handler(func=lambda query: gif_index is not None)
+@metrics.handler('inline')
+def handle_inline(query):
+    if not check_subscription(query.from_user.id):
+        bot.answer_inline_query(query.id, [], cache_time=0, is_personal=True, button=subscribe_button())
+        return
+    offset = int(query.offset) if query.offset.isdigit() else 0
+    results, next_offset = inline_results(query.query.strip(), offset)
+    # shared answers would reach users who are not subscribed, so they are cached per user while the gate is on
+    bot.answer_inline_query(
+        query.id, results, cache_time=config.INLINE_CACHE_TIME, is_personal=bool(config.REQUIRED_CHANNEL_ID), next_offset=next_offset)
+
 @bot.callback_query_handler(func=lambda call: True)
+@metrics.handler('callback')
 def handle_callback(call):
     user_id = call.from_user.id
-    if user_id not in user_states:
+    state = user_states.get(user_id)
+    if state is None:
         bot.answer_callback_query(call.id, lang["alert_session_expired"], show_alert=True)
         return
     
-    state = user_states[user_id]
     data = call.data
     
-    if data == "open_settings_main":
-        keyboard = create_main_settings_keyboard(user_id)
-        bot.edit_message_caption(caption=lang["settings_title"], chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=keyboard)
-    
-    elif data == "open_settings_fps":
-        keyboard = create_specific_setting_keyboard('fps', state['gif_settings']['fps'], FPS_OPTIONS)
-        bot.edit_message_caption(caption=lang["settings_menu_title_fps"], chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=keyboard)
-    
-    elif data == "open_settings_width":
-        keyboard = create_specific_setting_keyboard('width', state['gif_settings']['width'], WIDTH_OPTIONS)
-        bot.edit_message_caption(caption=lang["settings_menu_title_width"], chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=keyboard)
-    
-    elif data == "open_settings_colors":
-        keyboard = create_specific_setting_keyboard('colors', state['gif_settings']['colors'], COLOR_OPTIONS)
-        bot.edit_message_caption(caption=lang["settings_menu_title_colors"], chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=keyboard)
-    
-    elif data.startswith("set_"):
-        _, setting_type, value = data.split('_')
-        state['gif_settings'][setting_type] = int(value)
-        keyboard = create_main_settings_keyboard(user_id)
-        bot.edit_message_caption(caption=lang["settings_title"], chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=keyboard)
-        bot.answer_callback_query(call.id, lang["setting_changed"])
-
-    elif data == "back_to_main":
-        caption = lang["video_caption"].format(title=state['title'], duration=state['duration'])
-        keyboard = create_time_keyboard(state['start_time'], state['end_time'])
-        bot.edit_message_caption(caption=caption, chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=keyboard, parse_mode='Markdown')
+    view = settings_view(data, state, user_id)
+    if view:
+        caption, keyboard, parse_mode = view
+        bot.edit_message_caption(caption=caption, chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=keyboard, parse_mode=parse_mode)
+        if data.startswith("set_"):
+            bot.answer_callback_query(call.id, lang["setting_changed"])
     
     elif data.startswith("start_"):
         state['waiting_for'] = 'start_time'
         prompt_msg = bot.send_message(call.message.chat.id, lang["prompt_start_time"])
         state['prompt_message_id'] = prompt_msg.message_id
+        user_states.save(user_id, state)
         
     elif data.startswith("end_"):
         state['waiting_for'] = 'end_time'
         prompt_msg = bot.send_message(call.message.chat.id, lang["prompt_end_time"])
         state['prompt_message_id'] = prompt_msg.message_id
+        user_states.save(user_id, state)
         
     elif data.startswith("duration_"):
         state['waiting_for'] = 'duration'
         prompt_msg = bot.send_message(call.message.chat.id, lang["prompt_duration"].format(max_duration=config.MAX_GIF_DURATION))
         state['prompt_message_id'] = prompt_msg.message_id
+        user_states.save(user_id, state)
 
     elif data == "cancel":
         bot.delete_message(call.message.chat.id, call.message.message_id)
         del user_states[user_id]
     
-    elif data == "done":
+    elif data == "add_clip":
+        alert, added = add_clip(state)
+        if added:
+            user_states.save(user_id, state)
+            bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=session_keyboard(state))
+        bot.answer_callback_query(call.id, alert, show_alert=not added)
+
+    elif data == "preview":
+        if not check_range(call, state):
+            return
+        if send_cached_preview(call.message.chat.id, state):
+            bot.answer_callback_query(call.id)
+            return
+        if not check_render_queue(call, user_id):
+            return
         bot.answer_callback_query(call.id)
-        start_seconds = time_to_seconds(state['start_time'])
-        end_seconds = time_to_seconds(state['end_time'])
-        if end_seconds <= start_seconds:
-            bot.answer_callback_query(call.id, lang["alert_end_before_start"], show_alert=True)
+
+        process_msg = bot.send_message(call.message.chat.id, lang["creating_preview"].format(start_time=state['start_time'], end_time=state['end_time']))
+        job = build_job(user_id, call.message.chat.id, state, process_msg.message_id, kind='preview')
+        submit_job(job, finish_preview, fail_preview)
+
+    elif data == "done":
+        if not check_range(call, state):
             return
-        if (end_seconds - start_seconds) > config.MAX_GIF_DURATION:
-            bot.answer_callback_query(call.id, lang["alert_duration_too_long"].format(max_duration=config.MAX_GIF_DURATION), show_alert=True)
+        clips = batch_clips(state)
+        if len(clips) > config.BATCH_MAX_CLIPS:
+            bot.answer_callback_query(call.id, lang["alert_batch_full"].format(max_clips=config.BATCH_MAX_CLIPS), show_alert=True)
             return
         
+        if len(clips) < 2 and send_cached_gif(call.message.chat.id, state):
+            bot.answer_callback_query(call.id)
+            logging.info(f"User {user_id}: Served GIF from cache")
+            try: bot.delete_message(call.message.chat.id, state['message_id'])
+            except Exception: pass
+            del user_states[user_id]
+            return
+
+        if not check_render_queue(call, user_id):
+            return
+        bot.answer_callback_query(call.id)
+
         try: bot.delete_message(call.message.chat.id, state['message_id'])
         except Exception: pass
         
+        if len(clips) > 1:
+            # the whole batch is one queue job, so it counts once against the per-user limit
+            process_msg = bot.send_message(call.message.chat.id, lang["creating_batch"].format(count=len(clips)))
+            job = build_job(user_id, call.message.chat.id, state, process_msg.message_id, kind='batch')
+            del user_states[user_id]
+            submit_job(job, finish_batch, fail_render)
+            return
+
         process_msg = bot.send_message(call.message.chat.id, lang["creating_gif"].format(start_time=state['start_time'], end_time=state['end_time']))
         
-        mp4_file, raw_gif_file, final_gif_file = None, None, None
-        try:
-            mp4_file = tempfile.NamedTemporaryFile(suffix='.mp4', delete=False)
-            result = client.get_video(
-                url=state['url'], output_format='mp4',
-                start_time=state['start_time'], end_time=state['end_time'],
-                force_keyframes=True)
-            result.save_file(mp4_file.name)
-            mp4_file.close()
-
-            raw_gif_file = tempfile.NamedTemporaryFile(suffix='.gif', delete=False)
-            raw_gif_file.close()
-            final_gif_file = tempfile.NamedTemporaryFile(suffix='.gif', delete=False)
-            final_gif_file.close()
-
-            settings = state['gif_settings']
-            gif_fps = settings['fps']
-            gif_width = min(settings['width'], state.get('video_width', settings['width']))
-            gif_colors = settings['colors']
-            logging.info(f"User {user_id}: Using settings FPS:{gif_fps}, Width:{gif_width}, Colors:{gif_colors}")
-            
-            ffmpeg_filter = (
-                f'fps={gif_fps},scale={gif_width}:-1:flags=lanczos,'
-                f'split[s0][s1];[s0]palettegen=stats_mode=diff:max_colors={gif_colors}[p];'
-                f'[s1][p]paletteuse=dither=bayer:diff_mode=rectangle'
-            )
-            
-            subprocess.run([
-                'ffmpeg', '-i', mp4_file.name, '-vf', ffmpeg_filter,
-                '-y', raw_gif_file.name
-            ], check=True, capture_output=True, text=True)
-            
-            logging.info(f"User {user_id}: Optimizing GIF with gifsicle (lossy)...")
-            subprocess.run([
-                'gifsicle', '-O3', '--lossy=80', raw_gif_file.name, '-o', final_gif_file.name
-            ], check=True, capture_output=True, text=True)
+        job = build_job(user_id, call.message.chat.id, state, process_msg.message_id)
+        del user_states[user_id]
+        submit_job(job, finish_render, fail_render)
 
-            with open(final_gif_file.name, 'rb') as f:
-                bot.send_animation(call.message.chat.id, f, caption=lang["gif_ready"].format(title=state['title']))
-            
-            bot.delete_message(call.message.chat.id, process_msg.message_id)
-            del user_states[user_id]
-            
-        except subprocess.CalledProcessError as e:
-            logging.error(f"Processing failed for user {user_id}. Error: {e.stderr}")
-            bot.delete_message(call.message.chat.id, process_msg.message_id)
-            bot.send_message(call.message.chat.id, lang["error_creating_gif"])
-            if user_id in user_states: del user_states[user_id]
-        except Exception as e:
-            logging.error(f"Failed to create GIF for user {user_id}. URL: {state['url']}. Error: {e}")
-            bot.delete_message(call.message.chat.id, process_msg.message_id)
-            bot.send_message(call.message.chat.id, lang["error_creating_gif"])
-            if user_id in user_states: del user_states[user_id]
-        finally:
-            if mp4_file and os.path.exists(mp4_file.name): os.unlink(mp4_file.name)
-            if raw_gif_file and os.path.exists(raw_gif_file.name): os.unlink(raw_gif_file.name)
-            if final_gif_file and os.path.exists(final_gif_file.name): os.unlink(final_gif_file.name)
-
-    if not data.startswith(('start_', 'end_', 'duration_', 'set_')) and data != 'done':
+    if not data.startswith(('start_', 'end_', 'duration_', 'set_')) and data not in ('done', 'preview', 'add_clip'):
         bot.answer_callback_query(call.id)
 
 if __name__ == '__main__':
     logging.info("Bot is starting...")
+    gif_cache.invalidate(ENCODER_VERSION)
+    scratch.get_space().sweep()
+    metrics.SCRATCH_BYTES.set_function(lambda: scratch.get_space().usage())
+    export_cache_stats()
+    if config.RENDER_BACKEND == "sqlite":
+        render_queue.callbacks_for = job_callbacks
+    render_queue.start()
+    user_states.start_sweeper(config.SESSION_SWEEP_INTERVAL)
+    start_subscription_refresher()
+    if config.METRICS_PORT:
+        metrics.start_server(config.METRICS_HOST, config.METRICS_PORT)
+    atexit.register(user_states.flush)
     while True:
         try:
-            bot.infinity_polling(timeout=10, long_polling_timeout=5)
+            # chat_member updates are not delivered unless requested explicitly
+            bot.infinity_polling(timeout=10, long_polling_timeout=5, allowed_updates=util.update_types)
         except Exception as e:
             logging.error(f"Infinity polling exception: {e}")
             logging.info("Restarting in 15 seconds...")
@@ -0,0 +1,128 @@
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class TTLCache:
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._get_locked(key, default)
+
+    def _get_locked(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None or entry[1] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value, ttl=None):
+        with self._lock:
+            self._put_locked(key, value, ttl)
+
+    def _put_locked(self, key, value, ttl=None):
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._entries[key] = (value, expires)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+    def keys(self):
+        with self._lock:
+            return list(self._entries)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+class CoalescingCache(TTLCache):
+    def __init__(self, max_entries, ttl):
+        super().__init__(max_entries, ttl)
+        self._in_flight = {}
+
+    def get_or_fetch(self, key, fetch):
+        with self._lock:
+            value = self._get_locked(key)
+            if value is not None:
+                return value
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = self._in_flight[key] = Future()
+        if not owner:
+            return future.result()
+        try:
+            value = fetch()
+        except BaseException as e:
+            with self._lock:
+                del self._in_flight[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            self._put_locked(key, value)
+            del self._in_flight[key]
+        future.set_result(value)
+        return value
+
+
+MEMBER_STATUSES = ('member', 'administrator', 'creator')
+
+
+class MembershipCache(TTLCache):
+    def __init__(self, max_entries, positive_ttl, negative_ttl):
+        super().__init__(max_entries, positive_ttl)
+        self.negative_ttl = negative_ttl
+        self._stale = OrderedDict()
+
+    def lookup(self, user_id):
+        with self._lock:
+            entry = self._get_locked(user_id)
+            if entry is None:
+                return None
+            status, refresh_at = entry
+            is_member = status in MEMBER_STATUSES
+            # members still in use are revalidated in the background before their entry expires
+            if is_member and refresh_at < time.monotonic():
+                self._stale[user_id] = None
+            return is_member
+
+    def status(self, user_id):
+        entry = self.get(user_id)
+        return entry[0] if entry else None
+
+    def update(self, user_id, status):
+        is_member = status in MEMBER_STATUSES
+        ttl = self.ttl if is_member else self.negative_ttl
+        with self._lock:
+            self._put_locked(user_id, (status, time.monotonic() + ttl / 2), ttl)
+            self._stale.pop(user_id, None)
+        return is_member
+
+    def take_stale(self, limit):
+        with self._lock:
+            batch = list(itertools.islice(self._stale, limit))
+            for user_id in batch:
+                del self._stale[user_id]
+        return batch
@@ -15,3 +15,177 @@ REQUIRED_CHANNEL_ID = None  # Example: "@mychannel" or "-1001234567890"
 
 # Maximum GIF duration in seconds
 MAX_GIF_DURATION = 30
+
+# Render worker pool
+# Number of worker processes encoding GIFs in parallel
+RENDER_WORKERS = 2
+# Maximum number of queued and running jobs before new ones are rejected
+RENDER_QUEUE_LIMIT = 20
+# Maximum number of simultaneous jobs per user
+RENDER_USER_LIMIT = 1
+# Where jobs are rendered: "local" (worker processes of the bot itself) or "sqlite"
+# (a shared job queue served by separate `python worker.py` processes, RENDER_WORKERS is then the default of --slots)
+RENDER_BACKEND = "local"
+# Shared job queue and the directory workers leave finished files in, both must be reachable by the bot and every worker
+JOB_DB_PATH = "jobs.sqlite3"
+JOB_SPOOL_DIR = "job_spool"
+# WAL journaling only works when every process runs on the same host, disable it for a queue on a network filesystem
+JOB_DB_WAL = True
+# Seconds a worker's lease on a job lasts without a heartbeat before the job is handed to another worker
+JOB_LEASE_SECONDS = 60
+# Times a job is leased before it is failed (a worker dying on it counts as one attempt)
+JOB_MAX_ATTEMPTS = 3
+# Seconds between job queue polls of the bot and of idle workers
+JOB_POLL_INTERVAL = 1
+
+# GIF result cache (reuses Telegram file_ids for repeated requests)
+GIF_CACHE_PATH = "gif_cache.sqlite3"
+# Maximum number of cached GIFs (least recently used are evicted first)
+GIF_CACHE_MAX_ENTRIES = 10000
+# Time in seconds after which a cached GIF is re-encoded
+GIF_CACHE_TTL = 30 * 24 * 3600
+
+# Searchable index of every sent GIF for inline queries (@bot <title or url>), set to None to disable inline mode
+GIF_INDEX_PATH = "gif_index.sqlite3"
+GIF_INDEX_MAX_ENTRIES = 100000
+# Inline results per page, and seconds Telegram and the bot keep an answer cached
+INLINE_PAGE_SIZE = 20
+INLINE_CACHE_TIME = 300
+INLINE_CACHE_MAX_ENTRIES = 1000
+
+# Video info cache (metadata and thumbnails per video)
+INFO_CACHE_MAX_ENTRIES = 500
+# Time in seconds a video's info is reused before asking yt-dlp-host again
+INFO_CACHE_TTL = 600
+
+# Streaming encode: pipe the download through ffmpeg and gifsicle without temporary files
+# Needs TARGET_SIZE_ENCODING off and SOURCE_CACHE_DIR disabled, both need the source as a file
+STREAM_ENCODING = False
+# Container requested from yt-dlp-host while streaming (must be readable from a pipe, unlike mp4)
+STREAM_SOURCE_FORMAT = "mkv"
+# Sources larger than this (in bytes) are encoded via temporary files instead
+STREAM_MAX_SOURCE_BYTES = 64 * 1024 * 1024
+# GIFs larger than this (in bytes) are spooled to a temporary file instead of memory
+STREAM_MAX_MEMORY_BYTES = 32 * 1024 * 1024
+
+# File where encode time and output size of every job are appended as JSON lines
+# Leave empty or None to only log them
+ENCODE_STATS_PATH = "encode_stats.jsonl"
+
+# Target-size encoding: reduce FPS, width, colors and lossy level until the result fits the budget
+# Sources are always downloaded to a temporary file in this mode, since they are read more than once
+TARGET_SIZE_ENCODING = True
+# Maximum size of a sent GIF in bytes (Telegram bots can upload up to 50 MB)
+TARGET_SIZE_BYTES = 49 * 1024 * 1024
+# Length in seconds of the sample rendered to estimate the full size (only sampled once full quality is too large)
+TARGET_SIZE_SAMPLE_SECONDS = 1
+# Maximum number of full encodes, including the first one at full quality, before giving up
+TARGET_SIZE_MAX_ATTEMPTS = 3
+# A lowered result smaller than this share of the budget is encoded again one or more steps better
+TARGET_SIZE_STEP_UP = 0.85
+
+# Preview render settings (quick low-resolution GIF of the selected range)
+PREVIEW_FPS = 4
+PREVIEW_WIDTH = 240
+PREVIEW_CACHE_MAX_ENTRIES = 1000
+PREVIEW_CACHE_TTL = 3600
+
+# Downloaded source segments are kept here so previews and re-renders skip the download
+# Leave empty or None to disable (streaming encode is only used while the cache is disabled)
+SOURCE_CACHE_DIR = "source_cache"
+# Maximum total size of cached source segments in bytes
+SOURCE_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+# Overlapping or adjacent cached segments are merged up to this length in seconds
+SOURCE_CACHE_MAX_SPAN = 300
+
+# Two-pass palette: a separate lightweight pass builds the palette from PALETTE_SAMPLE_FPS frames per second,
+# so the encode no longer buffers every frame of the clip for palettegen
+PALETTE_ENGINE = True
+PALETTE_SAMPLE_FPS = 2
+# Directory of cached palettes per video, colors and width (set to None to disable), and its size in entries
+PALETTE_CACHE_DIR = "palette_cache"
+PALETTE_CACHE_MAX_ENTRIES = 5000
+# A cached palette is reused when its range overlaps at least this share of the union with the requested range
+PALETTE_REUSE_OVERLAP = 0.8
+# One palette per scene for clips with cuts, scenes shorter than SCENE_MIN_SECONDS are merged into the previous one
+PALETTE_PER_SCENE = False
+# ffmpeg scdet threshold (0-100), lower values detect more cuts
+SCENE_CUT_THRESHOLD = 10
+SCENE_MIN_SECONDS = 1
+
+# Segmented encoding: clips longer than SEGMENT_SECONDS are cut into segments of that many (whole) seconds,
+# encoded in parallel with the shared palette and merged with gifsicle (needs PALETTE_ENGINE)
+SEGMENT_ENCODING = True
+SEGMENT_SECONDS = 5
+# Segments encoded at the same time (None uses every CPU core)
+SEGMENT_THREADS = None
+
+# Temporary files of a job (downloads, spilled output, palettes) go to a per-job directory under SCRATCH_RAM_DIR
+# (a tmpfs, set to None to keep everything on disk) while all files there stay below SCRATCH_RAM_QUOTA bytes,
+# and to SCRATCH_DISK_DIR beyond that (None uses gifbot in the system temp directory).
+# The quota is capped at the size of the tmpfs (Docker gives /dev/shm 64 MB unless --shm-size says otherwise),
+# and a file that fills the tmpfs while it is written is moved to disk.
+# Directories left behind by a crashed process are removed on the next start.
+SCRATCH_RAM_DIR = "/dev/shm/gifbot"
+SCRATCH_DISK_DIR = None
+SCRATCH_RAM_QUOTA = 512 * 1024 * 1024
+# Space reserved in RAM for a file whose final size is not known when it is created; it counts against the quota until the file is removed
+SCRATCH_UNKNOWN_SIZE = 32 * 1024 * 1024
+
+# Session storage: "memory" or "sqlite" (survives restarts and can be shared by several bot processes)
+SESSION_BACKEND = "sqlite"
+SESSION_DB_PATH = "sessions.sqlite3"
+# Maximum number of stored sessions (least recently used are dropped first)
+SESSION_MAX_ENTRIES = 10000
+# Sessions idle for longer than this many seconds expire
+SESSION_TTL = 6 * 3600
+# How often in seconds expired sessions are removed
+SESSION_SWEEP_INTERVAL = 300
+# How often in seconds batched session writes are flushed to SQLite
+SESSION_FLUSH_INTERVAL = 1
+
+# Seconds before time input prompts and replies are cleaned up
+MESSAGE_DELETE_DELAY = 1
+# Maximum number of pooled HTTP connections used by async_bot.py
+HTTP_POOL_SIZE = 20
+
+# Channel membership cache (avoids a getChatMember call on every message)
+SUBSCRIPTION_CACHE_MAX_ENTRIES = 50000
+# Seconds a confirmed subscription is trusted; active members are revalidated in the background after half of it
+SUBSCRIPTION_POSITIVE_TTL = 3600
+# Seconds a missing subscription is remembered before asking Telegram again
+SUBSCRIPTION_NEGATIVE_TTL = 30
+# How often in seconds stale memberships are revalidated, and how many per round
+SUBSCRIPTION_REFRESH_INTERVAL = 30
+SUBSCRIPTION_REFRESH_BATCH = 20
+
+# Prometheus metrics endpoint (http://METRICS_HOST:METRICS_PORT/metrics), set the port to None to disable
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9464
+
+# Outbound Telegram call scheduler: calls per second overall, per private chat and per group or channel
+TELEGRAM_GLOBAL_RATE = 30
+TELEGRAM_PRIVATE_CHAT_RATE = 1
+TELEGRAM_GROUP_CHAT_RATE = 20 / 60
+# Calls a single chat may make in a quick burst before its rate applies
+TELEGRAM_CHAT_BURST = 3
+# Times a call rejected with a flood limit (429) is retried after its retry_after
+TELEGRAM_MAX_RETRIES = 3
+
+# Batch mode: several clips from one video, sent back as one media group
+BATCH_MAX_CLIPS = 10
+# Clips closer together than this many seconds share one downloaded source span
+BATCH_MAX_SPAN = 300
+# Clips encoded in parallel within one batch job (None uses every CPU core)
+BATCH_ENCODE_THREADS = None
+
+# Quality caps under load, lightest tier first. A tier applies once the render queue holds at least
+# queue_depth jobs or the 1-minute load average per CPU core reaches cpu_load; the last tier reached wins
+LOAD_TIERS = [
+    {'queue_depth': 6, 'cpu_load': 0.9, 'fps': 15, 'width': 480, 'colors': 128, 'optimize': 2},
+    {'queue_depth': 12, 'cpu_load': 1.5, 'fps': 10, 'width': 360, 'colors': 64, 'optimize': 1},
+]
+# Telegram user IDs whose jobs are never downgraded
+PRIORITY_USER_IDS = []
+# Administrators of REQUIRED_CHANNEL_ID are never downgraded either
+PRIORITY_CHANNEL_ADMINS = True
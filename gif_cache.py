@@ -0,0 +1,81 @@
+import logging
+import sqlite3
+import threading
+import time
+
+
+class GifCache:
+    def __init__(self, path, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('''
+            CREATE TABLE IF NOT EXISTS gifs (
+                key TEXT PRIMARY KEY,
+                encoder_version TEXT NOT NULL,
+                file_id TEXT NOT NULL,
+                created REAL NOT NULL,
+                last_used REAL NOT NULL
+            )''')
+        self._db.execute('CREATE INDEX IF NOT EXISTS gifs_last_used ON gifs (last_used)')
+        self._db.commit()
+
+    @staticmethod
+    def make_key(video_id, start_time, end_time, fps, width, colors, output_format, encoder_version):
+        return f"{video_id}|{start_time}|{end_time}|{fps}|{width}|{colors}|{output_format}|{encoder_version}"
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute('SELECT file_id, created FROM gifs WHERE key = ?', (key,)).fetchone()
+            if row and now - row[1] > self.ttl:
+                self._db.execute('DELETE FROM gifs WHERE key = ?', (key,))
+                self._db.commit()
+                row = None
+            if not row:
+                self.misses += 1
+                return None
+            self._db.execute('UPDATE gifs SET last_used = ? WHERE key = ?', (now, key))
+            self._db.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, encoder_version, file_id):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO gifs (key, encoder_version, file_id, created, last_used) VALUES (?, ?, ?, ?, ?)',
+                (key, encoder_version, file_id, now, now))
+            self._evict(now)
+            self._db.commit()
+
+    def discard(self, key):
+        with self._lock:
+            self._db.execute('DELETE FROM gifs WHERE key = ?', (key,))
+            self._db.commit()
+
+    def invalidate(self, current_encoder_version=None):
+        with self._lock:
+            if current_encoder_version is None:
+                removed = self._db.execute('DELETE FROM gifs').rowcount
+            else:
+                removed = self._db.execute('DELETE FROM gifs WHERE encoder_version != ?', (current_encoder_version,)).rowcount
+            self._db.commit()
+        if removed:
+            logging.info(f"GIF cache: invalidated {removed} entries")
+        return removed
+
+    def stats(self):
+        with self._lock:
+            size = self._db.execute('SELECT COUNT(*) FROM gifs').fetchone()[0]
+        return {'hits': self.hits, 'misses': self.misses, 'size': size}
+
+    def _evict(self, now):
+        self._db.execute('DELETE FROM gifs WHERE created < ?', (now - self.ttl,))
+        self._db.execute('''
+            DELETE FROM gifs WHERE key IN (
+                SELECT key FROM gifs ORDER BY last_used DESC LIMIT -1 OFFSET ?
+            )''', (self.max_entries,))
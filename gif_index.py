@@ -0,0 +1,102 @@
+import re
+import sqlite3
+import threading
+import time
+
+COLUMNS = ('file_id', 'title', 'video_id', 'start_time', 'end_time', 'fps', 'width', 'colors', 'format')
+
+
+class GifIndex:
+    def __init__(self, path, max_entries):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS gifs (
+                id INTEGER PRIMARY KEY,
+                key TEXT UNIQUE NOT NULL,
+                file_id TEXT NOT NULL,
+                title TEXT NOT NULL,
+                video_id TEXT NOT NULL,
+                start_time TEXT NOT NULL,
+                end_time TEXT NOT NULL,
+                fps INTEGER NOT NULL,
+                width INTEGER NOT NULL,
+                colors INTEGER NOT NULL,
+                format TEXT NOT NULL,
+                uses INTEGER NOT NULL DEFAULT 1,
+                created REAL NOT NULL,
+                last_used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS gifs_video_id ON gifs (video_id);
+            CREATE INDEX IF NOT EXISTS gifs_popular ON gifs (uses, last_used);
+            CREATE VIRTUAL TABLE IF NOT EXISTS gifs_fts USING fts5(title, content='gifs', content_rowid='id');
+            CREATE TRIGGER IF NOT EXISTS gifs_fts_insert AFTER INSERT ON gifs BEGIN
+                INSERT INTO gifs_fts (rowid, title) VALUES (new.id, new.title);
+            END;
+            CREATE TRIGGER IF NOT EXISTS gifs_fts_delete AFTER DELETE ON gifs BEGIN
+                INSERT INTO gifs_fts (gifs_fts, rowid, title) VALUES ('delete', old.id, old.title);
+            END;
+            CREATE TRIGGER IF NOT EXISTS gifs_fts_update AFTER UPDATE OF title ON gifs BEGIN
+                INSERT INTO gifs_fts (gifs_fts, rowid, title) VALUES ('delete', old.id, old.title);
+                INSERT INTO gifs_fts (rowid, title) VALUES (new.id, new.title);
+            END;
+        ''')
+        self._db.commit()
+
+    @staticmethod
+    def make_key(video_id, start_time, end_time, fps, width, colors, output_format):
+        return f"{video_id}|{start_time}|{end_time}|{fps}|{width}|{colors}|{output_format}"
+
+    def add(self, file_id, title, video_id, start_time, end_time, fps, width, colors, output_format):
+        now = time.time()
+        key = self.make_key(video_id, start_time, end_time, fps, width, colors, output_format)
+        with self._lock:
+            self._db.execute('''
+                INSERT INTO gifs (key, file_id, title, video_id, start_time, end_time, fps, width, colors, format, created, last_used)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET file_id = excluded.file_id, uses = uses + 1, last_used = excluded.last_used''',
+                (key, file_id, title, video_id, start_time, end_time, fps, width, colors, output_format, now, now))
+            self._db.execute('''
+                DELETE FROM gifs WHERE id IN (
+                    SELECT id FROM gifs ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                )''', (self.max_entries,))
+            self._db.commit()
+
+    def used(self, file_id):
+        with self._lock:
+            self._db.execute('UPDATE gifs SET uses = uses + 1, last_used = ? WHERE file_id = ?', (time.time(), file_id))
+            self._db.commit()
+
+    def discard(self, file_id):
+        with self._lock:
+            self._db.execute('DELETE FROM gifs WHERE file_id = ?', (file_id,))
+            self._db.commit()
+
+    @staticmethod
+    def _match_query(text):
+        # every word has to appear in the title, the last one may still be being typed
+        words = re.findall(r'\w+', text)
+        if not words:
+            return None
+        return ' '.join(f'"{word}"' for word in words[:-1]) + f' "{words[-1]}"*'
+
+    def search(self, text=None, video_id=None, offset=0, limit=20):
+        columns = ', '.join(f'gifs.{column}' for column in COLUMNS)
+        match = self._match_query(text or '')
+        if video_id:
+            query, params = f'SELECT {columns} FROM gifs WHERE video_id = ? ORDER BY uses DESC, last_used DESC', (video_id,)
+        elif match:
+            query = (f'SELECT {columns} FROM gifs_fts JOIN gifs ON gifs.id = gifs_fts.rowid '
+                     'WHERE gifs_fts MATCH ? ORDER BY bm25(gifs_fts), gifs.uses DESC')
+            params = (match,)
+        else:
+            query, params = f'SELECT {columns} FROM gifs ORDER BY uses DESC, last_used DESC', ()
+        with self._lock:
+            # one row more than asked for tells whether there is a next page
+            rows = self._db.execute(f'{query} LIMIT ? OFFSET ?', (*params, limit + 1, offset)).fetchall()
+        return [dict(zip(COLUMNS, row)) for row in rows[:limit]], len(rows) > limit
+
+    def stats(self):
+        with self._lock:
+            return {'size': self._db.execute('SELECT COUNT(*) FROM gifs').fetchone()[0]}
@@ -0,0 +1,235 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from render import OutputTooLarge
+from render_queue import QueueFull, UserLimitReached
+
+ACTIVE = ('queued', 'leased')
+
+
+class JobStore:
+    def __init__(self, path, lease_seconds, max_attempts, wal=True):
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        # autocommit, every write below opens its own IMMEDIATE transaction
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        if wal:
+            self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                job TEXT NOT NULL,
+                status TEXT NOT NULL,
+                stage TEXT,
+                worker TEXT,
+                lease_expires REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                result TEXT,
+                created REAL NOT NULL,
+                leased REAL
+            )''')
+        self._db.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)')
+
+    def _transaction(self, work):
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                result = work()
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+            return result
+
+    def _check_locked(self, user_id, max_depth, per_user_limit):
+        placeholders = ','.join('?' * len(ACTIVE))
+        user_jobs = self._db.execute(
+            f'SELECT COUNT(*) FROM jobs WHERE user_id = ? AND status IN ({placeholders})', (user_id, *ACTIVE)).fetchone()[0]
+        if user_jobs >= per_user_limit:
+            raise UserLimitReached()
+        queued = self._db.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+        depth = self._db.execute(f'SELECT COUNT(*) FROM jobs WHERE status IN ({placeholders})', ACTIVE).fetchone()[0]
+        if depth >= max_depth:
+            raise QueueFull(queued + 1)
+        return queued
+
+    def check(self, user_id, max_depth, per_user_limit):
+        with self._lock:
+            self._check_locked(user_id, max_depth, per_user_limit)
+
+    def submit(self, job, max_depth, per_user_limit):
+        def insert():
+            queued = self._check_locked(job['user_id'], max_depth, per_user_limit)
+            cursor = self._db.execute(
+                "INSERT INTO jobs (user_id, job, status, created) VALUES (?, ?, 'queued', ?)",
+                (job['user_id'], json.dumps(job), time.time()))
+            return cursor.lastrowid, queued + 1
+        return self._transaction(insert)
+
+    def depth(self):
+        with self._lock:
+            return self._db.execute(
+                f"SELECT COUNT(*) FROM jobs WHERE status IN ({','.join('?' * len(ACTIVE))})", ACTIVE).fetchone()[0]
+
+    def requeue_expired(self):
+        def requeue():
+            now = time.time()
+            failed = self._db.execute(
+                "UPDATE jobs SET status = 'failed', worker = NULL, result = ? "
+                "WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?",
+                (json.dumps({'error': 'render worker stopped responding'}), now, self.max_attempts)).rowcount
+            requeued = self._db.execute(
+                "UPDATE jobs SET status = 'queued', worker = NULL, stage = NULL "
+                "WHERE status = 'leased' AND lease_expires < ?", (now,)).rowcount
+            return failed, requeued
+        failed, requeued = self._transaction(requeue)
+        if failed or requeued:
+            logging.warning(f"Job queue: {requeued} expired leases requeued, {failed} jobs gave up after {self.max_attempts} attempts")
+
+    def lease(self, worker):
+        self.requeue_expired()
+
+        def take():
+            row = self._db.execute("SELECT id, job, created FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1").fetchone()
+            if not row:
+                return None
+            now = time.time()
+            self._db.execute(
+                "UPDATE jobs SET status = 'leased', worker = ?, lease_expires = ?, leased = ?, attempts = attempts + 1 WHERE id = ?",
+                (worker, now + self.lease_seconds, now, row[0]))
+            return row[0], json.loads(row[1]), now - row[2]
+        return self._transaction(take)
+
+    def _update_leased(self, job_id, worker, assignments, values):
+        with self._lock:
+            return self._db.execute(
+                f"UPDATE jobs SET {assignments} WHERE id = ? AND worker = ? AND status = 'leased'",
+                (*values, job_id, worker)).rowcount > 0
+
+    def heartbeat(self, job_id, worker):
+        return self._update_leased(job_id, worker, 'lease_expires = ?', (time.time() + self.lease_seconds,))
+
+    def set_stage(self, job_id, worker, stage):
+        return self._update_leased(job_id, worker, 'stage = ?', (stage,))
+
+    def complete(self, job_id, worker, result):
+        return self._update_leased(job_id, worker, "status = 'done', result = ?", (json.dumps(result),))
+
+    def fail(self, job_id, worker, error, too_large=False):
+        return self._update_leased(
+            job_id, worker, "status = 'failed', result = ?", (json.dumps({'error': error, 'too_large': too_large}),))
+
+    def release(self, job_id, worker):
+        # a graceful shutdown hands the job back without using up an attempt
+        return self._update_leased(job_id, worker, "status = 'queued', worker = NULL, stage = NULL, attempts = attempts - 1", ())
+
+    def jobs(self):
+        with self._lock:
+            rows = self._db.execute('SELECT id, job, status, stage, result FROM jobs ORDER BY id').fetchall()
+        return [(job_id, json.loads(job), status, stage, json.loads(result) if result else None)
+                for job_id, job, status, stage, result in rows]
+
+    def remove(self, job_id):
+        with self._lock:
+            return self._db.execute("DELETE FROM jobs WHERE id = ? AND status IN ('done', 'failed')", (job_id,)).rowcount > 0
+
+
+class DistributedRenderQueue:
+    # same interface as RenderQueue, but jobs are rendered by worker.py processes sharing the JobStore
+    def __init__(self, store, spool_dir, max_depth, per_user_limit, poll_interval, callbacks_for=None):
+        self.store = store
+        self.spool_dir = spool_dir
+        self.max_depth = max_depth
+        self.per_user_limit = per_user_limit
+        self.poll_interval = poll_interval
+        # returns (on_progress, on_done, on_error) for jobs submitted before this process started
+        self.callbacks_for = callbacks_for
+        self._lock = threading.Lock()
+        self._callbacks = {}
+        self._reported = {}
+        self._delivery = None
+
+    def start(self):
+        self._delivery = ThreadPoolExecutor(max_workers=4, thread_name_prefix='render-delivery')
+        threading.Thread(target=self._poll_loop, name='job-poll', daemon=True).start()
+
+    def depth(self):
+        return self.store.depth()
+
+    def check(self, user_id):
+        self.store.check(user_id, self.max_depth, self.per_user_limit)
+
+    def submit(self, job, on_progress, on_done, on_error):
+        job['submitted'] = time.time()
+        job['timings'] = {}
+        with self._lock:
+            job_id, position = self.store.submit(job, self.max_depth, self.per_user_limit)
+            self._callbacks[job_id] = (job, on_progress, on_done, on_error)
+            self._reported[job_id] = ('queued', position)
+        return position
+
+    def _poll_loop(self):
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                self._poll()
+            except Exception as e:
+                logging.error(f"Job queue poll failed: {e}")
+
+    def _entry(self, job_id, stored_job):
+        with self._lock:
+            entry = self._callbacks.get(job_id)
+            if entry is None and self.callbacks_for:
+                entry = self._callbacks[job_id] = (stored_job, *self.callbacks_for(stored_job))
+        return entry
+
+    def _poll(self):
+        self.store.requeue_expired()
+        position = 0
+        for job_id, stored_job, status, stage, result in self.store.jobs():
+            if status == 'queued':
+                position += 1
+            entry = self._entry(job_id, stored_job)
+            if entry is None:
+                continue
+            job, on_progress, on_done, on_error = entry
+            if status in ('done', 'failed'):
+                # removing first makes sure a second bot process never delivers the same job
+                if self.store.remove(job_id):
+                    self._delivery.submit(self._deliver, job_id, job, status, result, on_done, on_error)
+                continue
+            report = ('queued', position) if status == 'queued' else (stage or 'downloading', 0)
+            with self._lock:
+                if self._reported.get(job_id) == report:
+                    continue
+                self._reported[job_id] = report
+            try:
+                on_progress(job, *report)
+            except Exception as e:
+                logging.warning(f"Progress update failed for user {job['user_id']}: {e}")
+
+    def _deliver(self, job_id, job, status, result, on_done, on_error):
+        with self._lock:
+            self._callbacks.pop(job_id, None)
+            self._reported.pop(job_id, None)
+        job.setdefault('timings', {})
+        if status == 'failed':
+            error = result.get('error', 'unknown error')
+            on_error(job, OutputTooLarge(error) if result.get('too_large') else RuntimeError(error))
+            return
+        metrics.observe_stages(result['stages'], job['timings'])
+        job['timings']['queue_wait'] = result['queue_wait']
+        metrics.QUEUE_WAIT_SECONDS.observe(result['queue_wait'], kind=job.get('kind', 'render'))
+        job['gif_settings'] = result['settings']
+        job['downgraded'] = result['downgraded']
+        # workers store file names only, the spool may be mounted at a different path on each node
+        outputs = [os.path.join(self.spool_dir, name) for name in result['outputs']]
+        on_done(job, (outputs if result['batch'] else outputs[0], result['applied']))
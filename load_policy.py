@@ -0,0 +1,44 @@
+import logging
+import os
+
+import config
+from render import DEFAULT_OPTIMIZE
+
+
+def cpu_load():
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (AttributeError, OSError):
+        return 0.0
+
+def current_tier(queue_depth):
+    load = cpu_load()
+    tier = None
+    # tiers are ordered from the lightest to the heaviest, the last one reached wins
+    for candidate in config.LOAD_TIERS:
+        if queue_depth >= candidate['queue_depth'] or load >= candidate['cpu_load']:
+            tier = candidate
+    return tier
+
+def apply(job, queue_depth):
+    if job.get('priority') or job.get('kind') == 'preview':
+        return
+    tier = current_tier(queue_depth)
+    if not tier:
+        return
+    settings = job['gif_settings']
+    capped = dict(settings)
+    limits = [('fps', None), ('width', None)]
+    # the MP4 encoder has no palette and no gifsicle pass, capping those would only mark the result as lowered
+    if settings.get('format') != 'mp4':
+        limits += [('colors', None), ('optimize', DEFAULT_OPTIMIZE)]
+    for key, default in limits:
+        if key in tier and settings.get(key, default) > tier[key]:
+            capped[key] = tier[key]
+    if capped == settings:
+        return
+    logging.info(f"User {job['user_id']}: Load is high (queue depth {queue_depth}, CPU {cpu_load():.2f}), "
+                 f"settings capped from {settings} to {capped}")
+    job['gif_settings'] = capped
+    # a lighter gifsicle pass only makes the file a bit larger, the user is told about visible changes
+    job['downgraded'] = any(capped[key] != settings[key] for key, _ in limits if key != 'optimize')
@@ -9,6 +9,7 @@ TRANSLATIONS = {
                          "2. I'll show you information about the video\n"
                          "3. Choose the start and end times for the GIF\n"
                          "4. Maximum duration: {max_duration} seconds\n\n"
+                         "💡 To get several GIFs at once, send the link followed by time ranges, one per line (e.g. 0:10-0:15).\n\n"
                          "🔗 Just send the video link!",
         "prompt_start_time": "⏰ Enter the start time in HH:MM:SS format (e.g., 00:00:05):",
         "prompt_end_time": "⏰ Enter the end time in HH:MM:SS format (e.g., 00:00:16):",
@@ -26,10 +27,25 @@ TRANSLATIONS = {
                         "🏁 End: {end_time}\n\n"
                         "⏳ This may take some time...",
         "gif_ready": "✅ GIF is ready!\n📹 {title}",
+        "creating_preview": "👁 Creating preview...\n"
+                            "📍 Start: {start_time}\n"
+                            "🏁 End: {end_time}",
+        "preview_ready": "👁 Preview {start_time} – {end_time}",
+        "inline_caption": "📹 {title}",
+        "inline_description": "{start_time} – {end_time}, {fps} FPS, {width}px",
+        "inline_subscribe": "Subscribe to the channel to search GIFs",
+        "creating_batch": "🎬 Creating {count} GIFs...\n\n"
+                          "⏳ This may take some time...",
+        "batch_ready": "✅ {count} clips are ready!\n📹 {title}",
+        "clip_added": "✅ Clip added, {count} in the batch",
+        "settings_applied": "⚙️ Reduced to fit the size limit: {fps} FPS, {width}px, {colors} colors",
+        "settings_reduced_load": "⚙️ The bot is busy, so quality was lowered to {fps} FPS, {width}px, {colors} colors",
         "button_start": "📍 Start: {time}",
         "button_end": "🏁 End: {time}",
         "button_duration": "⏱️ Duration: {seconds}s",
         "button_done": "✅ Done",
+        "button_preview": "👁 Preview",
+        "button_add_clip": "➕ Add clip ({count})",
         "button_cancel": "❌ Cancel",
         "button_settings": "⚙️ Settings",
         "button_back": "⬅️ Back",
@@ -39,9 +55,11 @@ TRANSLATIONS = {
         "settings_menu_title_fps": "⚙️ Select FPS (Frames Per Second)",
         "settings_menu_title_width": "⚙️ Select Width (Resolution)",
         "settings_menu_title_colors": "⚙️ Select Color Palette Size",
+        "settings_menu_title_format": "⚙️ Select Output Format (MP4 is faster and smaller)",
         "setting_fps": "🚀 FPS: {value}",
         "setting_width": "↔️ Width: {value}px",
         "setting_colors": "🎨 Colors: {value}",
+        "setting_format": "🎞 Format: {value}",
         "setting_changed": "✅ Setting updated!",
         "error_invalid_url": "❌ Please send a valid YouTube video link",
         "error_getting_info": "❌ Error getting video information.",
@@ -53,10 +71,24 @@ TRANSLATIONS = {
         "error_duration_too_long": "❌ Maximum GIF duration: {max_duration} seconds",
         "error_duration_too_long_video": "❌ The resulting duration extends beyond the end of the video.",
         "error_creating_gif": "❌ An error occurred while creating the GIF.",
+        "error_creating_preview": "❌ An error occurred while creating the preview.",
+        "error_output_too_large": "❌ The GIF is too large to send even at the lowest quality. Try a shorter range.",
+        "error_batch_ranges": "❌ Could not read the clip list. Send the link followed by ranges, one per line, e.g.:\n"
+                              "0:10-0:15\n1:02-1:10\n"
+                              "Up to {max_clips} clips, each inside the video and at most {max_duration} seconds long.",
+        "alert_clip_exists": "This range is already in the batch",
+        "alert_batch_full": "❌ A batch can contain at most {max_clips} clips",
         "alert_session_expired": "❌ Session expired. Please send the link again.",
         "alert_cancelled": "❌ Cancelled",
         "alert_end_before_start": "❌ End time must be after the start time!",
         "alert_duration_too_long": "❌ Maximum duration: {max_duration} seconds!",
+        "alert_queue_full": "⏳ The queue is full, you would be at position {position}. Please try again later.",
+        "alert_render_in_progress": "⏳ Your previous GIF is still being created. Please wait.",
+        "error_queue_full": "❌ The queue is full. Please send the link again later.",
+        "progress_queued": "🕒 In queue, position: {position}",
+        "progress_downloading": "📥 Downloading the video...",
+        "progress_encoding": "🎞 Converting to GIF...",
+        "progress_uploading": "📤 Uploading...",
     },
     "ru": {
         "subscribe_prompt": "❌ Для использования бота необходимо подписаться на канал:\n"
@@ -68,6 +100,7 @@ TRANSLATIONS = {
                          "2. Я покажу информацию о видео\n"
                          "3. Выбери начало и конец для GIF\n"
                          "4. Максимальная длительность: {max_duration} секунд\n\n"
+                         "💡 Чтобы получить сразу несколько GIF, отправь ссылку и отрезки, по одному на строку (например, 0:10-0:15).\n\n"
                          "🔗 Просто отправь ссылку на видео!",
         "prompt_start_time": "⏰ Введите время начала в формате HH:MM:SS (например: 00:00:05):",
         "prompt_end_time": "⏰ Введите время конца в формате HH:MM:SS (например: 00:00:16):",
@@ -85,10 +118,25 @@ TRANSLATIONS = {
                         "🏁 Конец: {end_time}\n\n"
                         "⏳ Это может занять некоторое время...",
         "gif_ready": "✅ GIF готов!\n📹 {title}",
+        "creating_preview": "👁 Создаю превью...\n"
+                            "📍 Начало: {start_time}\n"
+                            "🏁 Конец: {end_time}",
+        "preview_ready": "👁 Превью {start_time} – {end_time}",
+        "inline_caption": "📹 {title}",
+        "inline_description": "{start_time} – {end_time}, {fps} FPS, {width}px",
+        "inline_subscribe": "Подпишитесь на канал, чтобы искать GIF",
+        "creating_batch": "🎬 Создаю {count} GIF...\n\n"
+                          "⏳ Это может занять некоторое время...",
+        "batch_ready": "✅ Готово клипов: {count}\n📹 {title}",
+        "clip_added": "✅ Клип добавлен, в пакете: {count}",
+        "settings_applied": "⚙️ Уменьшено до лимита размера: {fps} FPS, {width}px, {colors} цветов",
+        "settings_reduced_load": "⚙️ Бот сейчас загружен, поэтому качество снижено до {fps} FPS, {width}px, {colors} цветов",
         "button_start": "📍 Начало: {time}",
         "button_end": "🏁 Конец: {time}",
         "button_duration": "⏱️ Длительность: {seconds} сек",
         "button_done": "✅ Готово",
+        "button_preview": "👁 Превью",
+        "button_add_clip": "➕ Добавить клип ({count})",
         "button_cancel": "❌ Отмена",
         "button_settings": "⚙️ Настройки",
         "button_back": "⬅️ Назад",
@@ -98,9 +146,11 @@ TRANSLATIONS = {
         "settings_menu_title_fps": "⚙️ Выберите FPS (Кадров в секунду)",
         "settings_menu_title_width": "⚙️ Выберите ширину (Разрешение)",
         "settings_menu_title_colors": "⚙️ Выберите размер палитры",
+        "settings_menu_title_format": "⚙️ Выберите формат (MP4 быстрее и легче)",
         "setting_fps": "🚀 FPS: {value}",
         "setting_width": "↔️ Ширина: {value}px",
         "setting_colors": "🎨 Цветов: {value}",
+        "setting_format": "🎞 Формат: {value}",
         "setting_changed": "✅ Настройка обновлена!",
         "error_invalid_url": "❌ Пожалуйста, отправьте корректную ссылку на YouTube видео",
         "error_getting_info": "❌ Ошибка при получении информации о видео.",
@@ -112,9 +162,23 @@ TRANSLATIONS = {
         "error_duration_too_long": "❌ Максимальная длительность GIF: {max_duration} секунд",
         "error_duration_too_long_video": "❌ Указанная длительность выходит за пределы видео.",
         "error_creating_gif": "❌ Ошибка при создании GIF.",
+        "error_creating_preview": "❌ Ошибка при создании превью.",
+        "error_output_too_large": "❌ GIF слишком большой даже при минимальном качестве. Выберите отрезок короче.",
+        "error_batch_ranges": "❌ Не удалось прочитать список клипов. Отправьте ссылку и отрезки, по одному на строку, например:\n"
+                              "0:10-0:15\n1:02-1:10\n"
+                              "До {max_clips} клипов, каждый в пределах видео и не длиннее {max_duration} секунд.",
+        "alert_clip_exists": "Этот отрезок уже в пакете",
+        "alert_batch_full": "❌ В пакете может быть не больше {max_clips} клипов",
         "alert_session_expired": "❌ Сессия истекла. Отправьте ссылку заново.",
         "alert_cancelled": "❌ Отменено",
         "alert_end_before_start": "❌ Конец должен быть после начала!",
         "alert_duration_too_long": "❌ Максимальная длительность: {max_duration} секунд!",
+        "alert_queue_full": "⏳ Очередь заполнена, ваша позиция была бы {position}. Попробуйте позже.",
+        "alert_render_in_progress": "⏳ Ваш предыдущий GIF ещё создаётся. Пожалуйста, подождите.",
+        "error_queue_full": "❌ Очередь заполнена. Отправьте ссылку позже.",
+        "progress_queued": "🕒 В очереди, позиция: {position}",
+        "progress_downloading": "📥 Загружаю видео...",
+        "progress_encoding": "🎞 Конвертирую в GIF...",
+        "progress_uploading": "📤 Отправляю...",
     }
 }
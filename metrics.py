@@ -0,0 +1,256 @@
+import bisect
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SECONDS_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+BYTES_BUCKETS = (64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024, 10 * 1024 * 1024, 20 * 1024 * 1024, 50 * 1024 * 1024)
+
+_registry = []
+# stage timings of the job running in this render worker process, None outside of workers
+_collected = None
+_collected_lock = threading.Lock()
+# name of the bot handler the current Telegram API call is made from
+current_handler = contextvars.ContextVar('current_handler', default='background')
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._values = {}
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def collect(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_format_labels(zip(self.labels, key))} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=SECONDS_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # label values -> [bucket counts, sum, count]
+        self._values = {}
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def collect(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            values = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items())
+        for key, (counts, total, count) in values:
+            labels = list(zip(self.labels, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{_format_labels(labels + [("le", bound)])} {cumulative}')
+            lines.append(f'{self.name}_bucket{_format_labels(labels + [("le", "+Inf")])} {count}')
+            lines.append(f'{self.name}_sum{_format_labels(labels)} {total}')
+            lines.append(f'{self.name}_count{_format_labels(labels)} {count}')
+        return lines
+
+
+class Gauge:
+    def __init__(self, name, help, labels=(), metric_type='gauge'):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        # 'counter' for running totals kept elsewhere, like cache hits
+        self.metric_type = metric_type
+        # called at scrape time, returns {label value or tuple of label values: value}
+        self._function = None
+        _registry.append(self)
+
+    def set_function(self, function):
+        self._function = function
+
+    def collect(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.metric_type}']
+        if self._function is None:
+            return lines
+        try:
+            values = self._function()
+        except Exception as e:
+            logging.error(f"Could not collect {self.name}: {e}")
+            return lines
+        for key, value in sorted((key if isinstance(key, tuple) else (key,), value) for key, value in values.items()):
+            lines.append(f'{self.name}{_format_labels(zip(self.labels, key))} {value}')
+        return lines
+
+
+STAGE_SECONDS = Histogram('gifbot_stage_seconds', 'Time spent in each stage of a request', ('stage',))
+QUEUE_WAIT_SECONDS = Histogram('gifbot_queue_wait_seconds', 'Time render jobs wait in the queue', ('kind',))
+JOB_SECONDS = Histogram('gifbot_job_seconds', 'Time from queueing a job to delivering its result', ('kind', 'format', 'outcome'))
+OUTPUT_BYTES = Histogram('gifbot_output_bytes', 'Size of rendered animations', ('kind', 'format'), BYTES_BUCKETS)
+JOBS = Counter('gifbot_jobs_total', 'Finished render jobs', ('kind', 'format', 'outcome'))
+HANDLER_SECONDS = Histogram('gifbot_handler_seconds', 'Time spent in each bot handler', ('handler',))
+TELEGRAM_SECONDS = Histogram('gifbot_telegram_request_seconds', 'Telegram Bot API call latency', ('method', 'handler'))
+TELEGRAM_ERRORS = Counter('gifbot_telegram_errors_total', 'Failed Telegram Bot API calls', ('method', 'handler'))
+TELEGRAM_THROTTLE_SECONDS = Histogram('gifbot_telegram_throttle_seconds', 'Time Telegram calls wait for the rate limiter', ('method',))
+TELEGRAM_RATE_LIMITED = Counter('gifbot_telegram_rate_limited_total', 'Telegram calls answered with a flood limit and retried', ('method',))
+TELEGRAM_COALESCED = Counter('gifbot_telegram_coalesced_total', 'Telegram calls dropped or merged into another call', ('method', 'reason'))
+CACHE_LOOKUPS = Gauge('gifbot_cache_lookups_total', 'Cache lookups by cache and result', ('cache', 'result'), 'counter')
+CACHE_ENTRIES = Gauge('gifbot_cache_entries', 'Entries in each cache', ('cache',))
+SCRATCH_BYTES = Gauge('gifbot_scratch_bytes', 'Bytes of temporary job files in the scratch space', ('medium',))
+
+
+def record_stage(name, seconds, timings=None):
+    if _collected is not None:
+        # inside a render worker, the parent process observes these once the job returns
+        with _collected_lock:
+            _collected[name] = _collected.get(name, 0) + seconds
+    else:
+        STAGE_SECONDS.observe(seconds, stage=name)
+    if timings is not None:
+        timings[name] = timings.get(name, 0) + seconds
+
+@contextmanager
+def stage(name, timings=None):
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        record_stage(name, time.monotonic() - started, timings)
+
+@contextmanager
+def collect_stages():
+    global _collected
+    _collected = stages = {}
+    try:
+        yield stages
+    finally:
+        _collected = None
+
+def observe_stages(stages, timings=None):
+    for name, seconds in stages.items():
+        record_stage(name, seconds, timings)
+
+@contextmanager
+def telegram_call(method):
+    started = time.monotonic()
+    try:
+        yield
+    except Exception:
+        TELEGRAM_ERRORS.inc(method=method, handler=current_handler.get())
+        raise
+    finally:
+        TELEGRAM_SECONDS.observe(time.monotonic() - started, method=method, handler=current_handler.get())
+
+def handler(name):
+    def decorator(function):
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                token = current_handler.set(name)
+                try:
+                    with HANDLER_SECONDS.time(handler=name):
+                        return await function(*args, **kwargs)
+                finally:
+                    current_handler.reset(token)
+        else:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                token = current_handler.set(name)
+                try:
+                    with HANDLER_SECONDS.time(handler=name):
+                        return function(*args, **kwargs)
+                finally:
+                    current_handler.reset(token)
+        return wrapper
+    return decorator
+
+def log_job(job, outcome, size=None):
+    kind = job.get('kind', 'render')
+    output_format = job['gif_settings'].get('format', 'gif')
+    timings = job.get('timings', {})
+    total = time.time() - job['submitted'] if 'submitted' in job else None
+    JOBS.inc(kind=kind, format=output_format, outcome=outcome)
+    if total is not None:
+        JOB_SECONDS.observe(total, kind=kind, format=output_format, outcome=outcome)
+    if size is not None:
+        OUTPUT_BYTES.observe(size, kind=kind, format=output_format)
+    record = {
+        'user_id': job['user_id'], 'kind': kind, 'format': output_format, 'outcome': outcome,
+        'url': job['url'], 'start_time': job['start_time'], 'end_time': job['end_time'],
+        'fps': job['gif_settings']['fps'], 'width': job['gif_settings']['width'], 'colors': job['gif_settings']['colors'],
+        'bytes': size, 'total_seconds': round(total, 3) if total is not None else None,
+        'stages': {name: round(seconds, 3) for name, seconds in timings.items()},
+    }
+    logging.info(f"Job finished {json.dumps(record)}")
+
+def exposition():
+    lines = []
+    for metric in _registry:
+        lines += metric.collect()
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = exposition().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(host, port):
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logging.info(f"Metrics are served on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,120 @@
+import hashlib
+import logging
+import os
+import re
+import subprocess
+import tempfile
+from contextlib import contextmanager
+
+import metrics
+import scratch
+
+
+class PaletteCache:
+    def __init__(self, directory, max_entries, min_overlap):
+        self.directory = directory
+        self.max_entries = max_entries
+        # a cached palette is reused when it covers this share of the union of both ranges
+        self.min_overlap = min_overlap
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def _prefix(video_id, colors, width):
+        return hashlib.sha1(f"{video_id}|{colors}|{width}".encode()).hexdigest()[:20]
+
+    def _path(self, video_id, colors, width, start, end):
+        # range bounds are stored in milliseconds so scene boundaries fit too
+        return os.path.join(self.directory, f"{self._prefix(video_id, colors, width)}_{round(start * 1000)}_{round(end * 1000)}.png")
+
+    def get(self, video_id, colors, width, start, end):
+        prefix = self._prefix(video_id, colors, width) + '_'
+        best, best_overlap = None, self.min_overlap
+        for name in os.listdir(self.directory):
+            if not name.startswith(prefix) or not name.endswith('.png'):
+                continue
+            try:
+                cached_start, cached_end = (int(value) / 1000 for value in name[len(prefix):-len('.png')].split('_'))
+            except ValueError:
+                continue
+            union = max(end, cached_end) - min(start, cached_start)
+            overlap = (min(end, cached_end) - max(start, cached_start)) / union if union > 0 else 0
+            if overlap >= best_overlap:
+                best, best_overlap = os.path.join(self.directory, name), overlap
+        if best:
+            try:
+                # mtime doubles as the LRU timestamp
+                os.utime(best)
+            except FileNotFoundError:
+                return None
+        return best
+
+    def put(self, video_id, colors, width, start, end, generate):
+        path = self._path(video_id, colors, width, start, end)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.png.part')
+        os.close(fd)
+        try:
+            generate(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path): os.unlink(tmp_path)
+        self._evict()
+        return path
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.png'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                entries.append((os.stat(path).st_mtime, path))
+            except FileNotFoundError:
+                continue
+        for _, path in sorted(entries)[:max(len(entries) - self.max_entries, 0)]:
+            try: os.unlink(path)
+            except FileNotFoundError: pass
+
+
+def build_palette_filter(fps, width, colors):
+    # stats over the sampled frames only; unlike the single-graph filter nothing is buffered until the end of the clip
+    return f'fps={fps},scale={width}:-1:flags=lanczos,palettegen=stats_mode=full:max_colors={colors}'
+
+def generate(source, sample_fps, width, colors, path):
+    with metrics.stage('palettegen'):
+        subprocess.run([
+            'ffmpeg', '-loglevel', 'error', *source.input_args(),
+            '-vf', build_palette_filter(sample_fps, width, colors), '-frames:v', '1', '-update', '1', '-y', path
+        ], check=True, capture_output=True, text=True)
+
+@contextmanager
+def palette(cache, video_id, source, start, end, sample_fps, width, colors):
+    # yields the path of a palette for the range, generated in its own pass unless a similar range is cached
+    if cache and video_id:
+        path = cache.get(video_id, colors, width, start, end)
+        if path:
+            yield path
+            return
+        yield cache.put(video_id, colors, width, start, end, lambda tmp_path: generate(source, sample_fps, width, colors, tmp_path))
+        return
+    path = scratch.create('.png', lambda path: generate(source, sample_fps, width, colors, path))
+    try:
+        yield path
+    finally:
+        os.unlink(path)
+
+def detect_scenes(source, sample_fps, threshold, min_length):
+    # returns scene start offsets in seconds relative to the source, always starting with 0
+    with metrics.stage('scdet'):
+        result = subprocess.run([
+            'ffmpeg', '-hide_banner', '-nostats', '-loglevel', 'info', *source.input_args(),
+            '-vf', f'fps={sample_fps},scale=320:-1,scdet=threshold={threshold}', '-an', '-f', 'null', '-'
+        ], check=True, capture_output=True, text=True)
+    starts = [0.0]
+    for match in re.finditer(r'lavfi\.scd\.time: ([\d.]+)', result.stderr):
+        time = float(match.group(1))
+        if time - starts[-1] >= min_length:
+            starts.append(time)
+    if source.duration and len(starts) > 1 and source.duration - starts[-1] < min_length:
+        starts.pop()
+    logging.info(f"Detected {len(starts)} scenes at {starts}")
+    return starts
@@ -0,0 +1,698 @@
+import yt_dlp_host_api
+from yt_dlp_host_api.exceptions import APIError
+import config
+import os
+import logging
+import subprocess
+import hashlib
+import json
+import time
+import threading
+import signal
+import math
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
+from utils import time_to_seconds, seconds_to_time, extract_video_id
+from source_cache import SourceCache
+import metrics
+import palette
+import scratch
+import requests
+from io import BytesIO
+
+_client = None
+_source_cache = None
+_palette_cache = None
+
+
+class OutputTooLarge(Exception):
+    pass
+
+
+class Source:
+    def __init__(self, path, offset=0, duration=None, temporary=False, lock=None):
+        self.path = path
+        self.offset = offset
+        self.duration = duration
+        self.temporary = temporary
+        # shared lock that keeps a cached segment from being merged away or evicted while the job reads it
+        self.lock = lock
+        # scene start offsets, detected once per source
+        self.scenes = None
+
+    @property
+    def whole(self):
+        return not self.offset and self.duration is None
+
+    def input_args(self, limit=None):
+        args = ['-ss', str(self.offset)] if self.offset else []
+        length = min(filter(None, (limit, self.duration)), default=None)
+        if length:
+            args += ['-t', str(length)]
+        return [*args, '-i', self.path]
+
+    def release(self):
+        if self.temporary and os.path.exists(self.path): os.unlink(self.path)
+        if self.lock:
+            self.lock.close()
+
+
+CHUNK_SIZE = 64 * 1024
+
+def get_client():
+    global _client
+    if _client is None:
+        api = yt_dlp_host_api.api(config.YT_DLP_HOST_URL)
+        _client = api.get_client(config.YT_DLP_API_KEY)
+    return _client
+
+def get_source_cache():
+    global _source_cache
+    if _source_cache is None and config.SOURCE_CACHE_DIR:
+        _source_cache = SourceCache(config.SOURCE_CACHE_DIR, config.SOURCE_CACHE_MAX_BYTES, config.SOURCE_CACHE_MAX_SPAN)
+    return _source_cache
+
+def get_palette_cache():
+    global _palette_cache
+    if _palette_cache is None and config.PALETTE_CACHE_DIR:
+        _palette_cache = palette.PaletteCache(config.PALETTE_CACHE_DIR, config.PALETTE_CACHE_MAX_ENTRIES, config.PALETTE_REUSE_OVERLAP)
+    return _palette_cache
+
+def build_gif_filter(fps, width, colors):
+    return (
+        f'fps={fps},scale={width}:-1:flags=lanczos,'
+        f'split[s0][s1];[s0]palettegen=stats_mode=diff:max_colors={colors}[p];'
+        f'[s1][p]paletteuse=dither=bayer:diff_mode=rectangle'
+    )
+
+def build_paletteuse_filter(fps, width):
+    # the palette comes from a second input, so frames flow straight through
+    return f'[0:v]fps={fps},scale={width}:-1:flags=lanczos[x];[x][1:v]paletteuse=dither=bayer:diff_mode=rectangle'
+
+DEFAULT_LOSSY = 80
+
+DEFAULT_OPTIMIZE = 3
+
+def gifsicle_args(lossy=DEFAULT_LOSSY, optimize=DEFAULT_OPTIMIZE):
+    return [f'-O{optimize}', f'--lossy={lossy}']
+
+GIFSICLE_ARGS = gifsicle_args()
+
+# Choices offered in the settings menu
+FPS_OPTIONS = [10, 15, 20, 25]
+WIDTH_OPTIONS = [360, 480, 720, 1080]
+COLOR_OPTIONS = [64, 128, 256]
+FORMAT_OPTIONS = ['gif', 'mp4']
+
+# Quality ladders used to fit a size budget, best quality first
+LOSSY_STEPS = [80, 120, 160, 200]
+FPS_STEPS = [25, 20, 15, 10, 8]
+WIDTH_STEPS = [1080, 720, 480, 360, 240]
+COLOR_STEPS = [256, 128, 64, 32]
+
+MP4_ARGS = ['-an', '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23', '-pix_fmt', 'yuv420p', '-movflags', '+faststart']
+
+
+def build_mp4_filter(fps, width):
+    return f'fps={fps},scale={width}:-2:flags=lanczos'
+
+# Changes whenever the filter chains or encoder flags change, which invalidates cached results
+ENCODER_VERSION = hashlib.sha1(
+    (build_gif_filter('{fps}', '{width}', '{colors}') + ' '.join(GIFSICLE_ARGS) +
+     build_paletteuse_filter('{fps}', '{width}') + palette.build_palette_filter('{fps}', '{width}', '{colors}') +
+     build_mp4_filter('{fps}', '{width}') + ' '.join(MP4_ARGS)).encode()
+).hexdigest()[:12]
+
+def effective_width(settings, video_width):
+    return min(settings['width'], video_width or settings['width'])
+
+def open_download(result):
+    client = get_client()
+    response = requests.get(result.get_file_url(), headers=client.headers, stream=True, timeout=60)
+    if response.status_code != 200:
+        response.close()
+        raise APIError(f"Download failed with status {response.status_code}")
+    return response
+
+def collect_output(stream):
+    buffer = BytesIO()
+    spill = None
+    try:
+        for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+            if spill:
+                spill.write(chunk)
+                continue
+            buffer.write(chunk)
+            if buffer.tell() > config.STREAM_MAX_MEMORY_BYTES:
+                spill = scratch.open_file('.gif')
+                spill.write(buffer.getvalue())
+                buffer = None
+    except BaseException:
+        if spill:
+            spill.close()
+            os.unlink(spill.name)
+        raise
+    if spill:
+        spill.close()
+        return spill.name
+    return buffer.getvalue()
+
+def run_pipeline(chunks, commands):
+    procs = []
+    stderr = {}
+    errors = []
+    started = {}
+    finished = {}
+
+    def drain(proc, index):
+        stderr[index] = proc.stderr.read().decode(errors='replace')
+        proc.wait()
+        finished[index] = time.monotonic()
+
+    def feed(proc):
+        try:
+            for chunk in chunks:
+                proc.stdin.write(chunk)
+        except BrokenPipeError:
+            pass
+        except Exception as e:
+            errors.append(e)
+        finally:
+            try: proc.stdin.close()
+            except BrokenPipeError: pass
+
+    threads = []
+    try:
+        for index, cmd in enumerate(commands):
+            stdin = procs[-1].stdout if procs else subprocess.PIPE
+            started[index] = time.monotonic()
+            proc = subprocess.Popen(cmd, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            if procs: procs[-1].stdout.close()
+            procs.append(proc)
+            threads.append(threading.Thread(target=drain, args=(proc, index), daemon=True))
+        threads.append(threading.Thread(target=feed, args=(procs[0],), daemon=True))
+        for thread in threads: thread.start()
+        output = collect_output(procs[-1].stdout)
+        for proc in procs: proc.wait()
+        for thread in threads: thread.join()
+    finally:
+        for proc in procs:
+            if proc.poll() is None: proc.kill()
+    # the stages run concurrently, so each one is timed from its start until it exits
+    for index in finished:
+        metrics.record_stage(commands[index][0], finished[index] - started[index])
+    if errors:
+        if isinstance(output, str): os.unlink(output)
+        raise errors[0]
+    failed = [index for index, proc in enumerate(procs) if proc.returncode != 0]
+    if failed:
+        if isinstance(output, str): os.unlink(output)
+        # upstream stages die of SIGPIPE when a later stage fails, so report the real cause
+        index = next((i for i in failed if procs[i].returncode != -signal.SIGPIPE), failed[0])
+        raise subprocess.CalledProcessError(procs[index].returncode, commands[index], stderr=stderr.get(index, ''))
+    return output
+
+def encode_gif_stream(response, gif_filter, optimize=DEFAULT_OPTIMIZE, palette_path=None):
+    filter_args = ['-i', palette_path, '-lavfi', gif_filter] if palette_path else ['-vf', gif_filter]
+    return run_pipeline(response.iter_content(CHUNK_SIZE), [
+        ['ffmpeg', '-loglevel', 'error', '-i', 'pipe:0', *filter_args, '-f', 'gif', 'pipe:1'],
+        ['gifsicle', *gifsicle_args(optimize=optimize)],
+    ])
+
+def download_to_file(response, suffix):
+    source_file = scratch.open_file(suffix, int(response.headers.get('Content-Length') or 0))
+    try:
+        with metrics.stage('download'):
+            for chunk in response.iter_content(CHUNK_SIZE):
+                source_file.write(chunk)
+    except BaseException:
+        source_file.close()
+        os.unlink(source_file.name)
+        raise
+    source_file.close()
+    return source_file
+
+def encode_gif_pipe(source, fps, width, colors, lossy=DEFAULT_LOSSY, limit=None, optimize=DEFAULT_OPTIMIZE, palette_path=None, frames=None):
+    if palette_path:
+        filter_args = ['-i', palette_path, '-lavfi', build_paletteuse_filter(fps, width)]
+    else:
+        filter_args = ['-vf', build_gif_filter(fps, width, colors)]
+    frame_args = ['-frames:v', str(frames)] if frames else []
+    return run_pipeline(iter(()), [
+        ['ffmpeg', '-loglevel', 'error', *source.input_args(limit), *filter_args, *frame_args, '-f', 'gif', 'pipe:1'],
+        ['gifsicle', *gifsicle_args(lossy, optimize)],
+    ])
+
+def job_palette(job, source, width, colors, offset=0, length=None):
+    # offset and length select a part of the job's range, e.g. one scene
+    start = time_to_seconds(job['start_time']) + offset
+    end = start + length if length is not None else time_to_seconds(job['end_time'])
+    return palette.palette(
+        get_palette_cache(), extract_video_id(job['url']), source, start, end, config.PALETTE_SAMPLE_FPS, width, colors)
+
+def clip_duration(job, source, limit=None):
+    duration = source.duration or time_to_seconds(job['end_time']) - time_to_seconds(job['start_time'])
+    return min(duration, limit) if limit else duration
+
+def split_segments(duration, length):
+    # whole-second boundaries keep every segment on the fps grid of the serial encode
+    starts = list(range(0, math.ceil(duration), length))
+    if len(starts) > 1 and duration - starts[-1] < length / 2:
+        starts.pop()
+    return [(start, (starts[index + 1] if index + 1 < len(starts) else duration) - start) for index, start in enumerate(starts)]
+
+def spill_to_file(output):
+    if isinstance(output, str):
+        return output
+    with scratch.open_file('.gif', len(output)) as f:
+        f.write(output)
+    return f.name
+
+def encode_gif_parts(source, parts, fps, width, lossy=DEFAULT_LOSSY, optimize=DEFAULT_OPTIMIZE):
+    # parts are (offset, length, palette path, frame count or None), every one is its own ffmpeg and gifsicle pipeline
+    def encode(offset, length, palette_path, frames):
+        part = Source(source.path, source.offset + offset, length)
+        return spill_to_file(encode_gif_pipe(part, fps, width, None, lossy, optimize=optimize, palette_path=palette_path, frames=frames))
+
+    with ThreadPoolExecutor(max_workers=config.SEGMENT_THREADS or os.cpu_count()) as pool:
+        futures = [pool.submit(encode, *part) for part in parts]
+    files = [future.result() for future in futures if not future.exception()]
+    try:
+        failed = [future.exception() for future in futures if future.exception()]
+        if failed:
+            raise failed[0]
+        # parts are already optimized, merging only concatenates their frames
+        return run_pipeline(iter(()), [['gifsicle', '--merge', *files]])
+    finally:
+        for path in files:
+            if os.path.exists(path): os.unlink(path)
+
+def encode_gif_scenes(job, source, scenes, fps, width, colors, lossy=DEFAULT_LOSSY, limit=None, optimize=DEFAULT_OPTIMIZE):
+    duration = clip_duration(job, source, limit)
+    bounds = [start for start in scenes if start < duration] + [duration]
+    with ExitStack() as palettes:
+        parts = []
+        for start, end in zip(bounds, bounds[1:]):
+            scene = Source(source.path, source.offset + start, end - start)
+            palette_path = palettes.enter_context(job_palette(job, scene, width, colors, start, end - start))
+            # every scene keeps its own palette as a local color table
+            parts.append((start, end - start, palette_path, None))
+        return encode_gif_parts(source, parts, fps, width, lossy, optimize)
+
+def encode_gif(job, source, fps, width, colors, lossy=DEFAULT_LOSSY, limit=None, optimize=DEFAULT_OPTIMIZE):
+    if not config.PALETTE_ENGINE:
+        return encode_gif_pipe(source, fps, width, colors, lossy, limit, optimize)
+    if config.PALETTE_PER_SCENE:
+        if source.scenes is None:
+            source.scenes = palette.detect_scenes(
+                source, config.PALETTE_SAMPLE_FPS * 2, config.SCENE_CUT_THRESHOLD, config.SCENE_MIN_SECONDS)
+        if len(source.scenes) > 1:
+            return encode_gif_scenes(job, source, source.scenes, fps, width, colors, lossy, limit, optimize)
+    with job_palette(job, source, width, colors) as palette_path:
+        duration = clip_duration(job, source, limit)
+        # batch clips are already encoded in parallel with each other
+        if config.SEGMENT_ENCODING and job.get('kind') != 'batch' and duration > config.SEGMENT_SECONDS:
+            segments = split_segments(duration, config.SEGMENT_SECONDS)
+            logging.info(f"User {job['user_id']}: Encoding {duration}s in {len(segments)} parallel segments")
+            parts = [
+                (offset, length, palette_path, round(length * fps) if index + 1 < len(segments) else None)
+                for index, (offset, length) in enumerate(segments)]
+            return encode_gif_parts(source, parts, fps, width, lossy, optimize)
+        return encode_gif_pipe(source, fps, width, colors, lossy, limit, optimize, palette_path)
+
+def discard_output(output):
+    if isinstance(output, str) and os.path.exists(output): os.unlink(output)
+
+def _degrade(value, steps, lower_is_worse=True):
+    worse = [v for v in steps if (v < value if lower_is_worse else v > value)]
+    if not worse:
+        return None
+    return max(worse) if lower_is_worse else min(worse)
+
+def size_ladder(fps, width, colors, lossy=DEFAULT_LOSSY):
+    current = {'lossy': lossy, 'colors': colors, 'fps': fps, 'width': width}
+    steps = {'lossy': LOSSY_STEPS, 'colors': COLOR_STEPS, 'fps': FPS_STEPS, 'width': WIDTH_STEPS}
+    ladder = [dict(current)]
+    order = ['lossy', 'colors', 'fps', 'width']
+    index, exhausted = 0, 0
+    while exhausted < len(order):
+        key = order[index % len(order)]
+        index += 1
+        value = _degrade(current[key], steps[key], lower_is_worse=(key != 'lossy'))
+        if value is None:
+            exhausted += 1
+            continue
+        exhausted = 0
+        current[key] = value
+        ladder.append(dict(current))
+    return ladder
+
+def gif_frame_ends(data):
+    # byte offset where each frame of a GIF ends, the first one includes the header and global palette
+    pos = 13
+    if data[10] & 0x80:
+        pos += 3 * 2 ** ((data[10] & 7) + 1)
+    ends = []
+
+    def skip_sub_blocks(pos):
+        while data[pos]:
+            pos += data[pos] + 1
+        return pos + 1
+
+    while data[pos] != 0x3B:
+        if data[pos] == 0x21:
+            pos = skip_sub_blocks(pos + 2)
+        elif data[pos] == 0x2C:
+            flags = data[pos + 9]
+            pos += 10
+            if flags & 0x80:
+                pos += 3 * 2 ** ((flags & 7) + 1)
+            pos = skip_sub_blocks(pos + 1)
+            ends.append(pos)
+        else:
+            raise ValueError(f"Unexpected GIF block {data[pos]:#x} at {pos}")
+    return ends
+
+def estimate_gif_size(sample, frames):
+    # the first frame is a full picture, later ones only store what changed, so only those scale with the length
+    data = sample if isinstance(sample, bytes) else open(sample, 'rb').read()
+    try:
+        ends = gif_frame_ends(data)
+    except (IndexError, ValueError):
+        ends = []
+    if len(ends) < 2:
+        return len(data) * max(frames / max(len(ends), 1), 1)
+    delta = (len(data) - ends[0]) / (len(ends) - 1)
+    return ends[0] + delta * (frames - 1)
+
+def encode_gif_to_budget(job, source, fps, width, colors, duration, optimize=DEFAULT_OPTIMIZE):
+    budget = config.TARGET_SIZE_BYTES
+    duration = max(duration, 1)
+    sample_seconds = min(config.TARGET_SIZE_SAMPLE_SECONDS, duration)
+    ladder = size_ladder(fps, width, colors)
+    estimates = {}
+
+    def estimate(index):
+        if index not in estimates:
+            step = ladder[index]
+            sample = encode_gif(job, source, step['fps'], step['width'], step['colors'], step['lossy'], sample_seconds, optimize)
+            estimates[index] = estimate_gif_size(sample, max(round(duration * step['fps']), 1))
+            discard_output(sample)
+        return estimates[index]
+
+    def first_fitting(lo, hi, correction):
+        # best step in lo..hi expected to fit, hi if none is
+        if estimate(hi) * correction > budget:
+            return hi
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if estimate(mid) * correction <= budget: hi = mid
+            else: lo = mid + 1
+        return lo
+
+    def encode_step(index, attempt):
+        step = ladder[index]
+        output = encode_gif(job, source, step['fps'], step['width'], step['colors'], step['lossy'], optimize=optimize)
+        size = result_size(output)
+        logging.info(f"User {job['user_id']}: Budget encode attempt {attempt + 1} with {step} produced {size} bytes "
+                     f"(estimated {int(estimates.get(index, size))}, budget {budget})")
+        return output, size
+
+    # most clips fit at full quality, those are encoded once without any samples
+    output, size = encode_step(0, 0)
+    if size <= budget:
+        return output, ladder[0]
+    discard_output(output)
+    if len(ladder) == 1:
+        raise OutputTooLarge(f"Could not fit the GIF into {budget} bytes")
+    # how far off the estimates are for this clip, refined by every full encode
+    correction = size / estimate(0)
+    # ladder steps above too_large are known not to fit, best holds the best step that did
+    too_large, best = 0, None
+    index = first_fitting(1, len(ladder) - 1, correction)
+    for attempt in range(1, config.TARGET_SIZE_MAX_ATTEMPTS):
+        output, size = encode_step(index, attempt)
+        correction = size / estimate(index)
+        if size <= budget:
+            if best:
+                discard_output(best[1])
+            best = (index, output)
+        else:
+            discard_output(output)
+            too_large = index
+        if best and (best[0] - too_large <= 1 or size > budget * config.TARGET_SIZE_STEP_UP):
+            break
+        if best:
+            # came in well under the budget, a better step may fit as well
+            index = first_fitting(too_large + 1, best[0] - 1, correction)
+            if estimate(index) * correction > budget:
+                break
+        elif index == len(ladder) - 1:
+            break
+        else:
+            index = first_fitting(index + 1, len(ladder) - 1, correction)
+    if best:
+        return best[1], ladder[best[0]]
+    raise OutputTooLarge(f"Could not fit the GIF into {budget} bytes")
+
+def probe_video(path):
+    with metrics.stage('ffprobe'):
+        result = subprocess.run([
+            'ffprobe', '-v', 'error', '-select_streams', 'v:0',
+            '-show_entries', 'stream=codec_name,width,avg_frame_rate', '-of', 'json', path
+        ], check=True, capture_output=True, text=True)
+    stream = json.loads(result.stdout)['streams'][0]
+    num, _, den = stream.get('avg_frame_rate', '0/1').partition('/')
+    fps = float(num) / float(den or 1) if float(den or 1) else 0
+    return stream.get('codec_name'), stream.get('width', 0), fps
+
+def encode_mp4_file(source, fps, width, duration, user_id):
+    codec, source_width, source_fps = probe_video(source.path)
+    fits_budget = not config.TARGET_SIZE_ENCODING or os.path.getsize(source.path) <= config.TARGET_SIZE_BYTES
+    # stream copy can only cut on keyframes, so sub-ranges of a cached segment are re-encoded
+    if source.whole and codec == 'h264' and source_width <= width and 0 < source_fps <= fps and fits_budget:
+        logging.info(f"User {user_id}: Stream-copying H.264 source into MP4 animation")
+        args = ['-an', '-c:v', 'copy', '-movflags', '+faststart']
+    else:
+        args = ['-vf', build_mp4_filter(fps, width), *MP4_ARGS]
+        if config.TARGET_SIZE_ENCODING and duration:
+            # cap the bitrate so the whole clip stays below the byte budget
+            bitrate = int(config.TARGET_SIZE_BYTES * 8 * 0.9 / duration)
+            args += ['-maxrate', str(bitrate), '-bufsize', str(bitrate * 2)]
+
+    def encode(output_path):
+        with metrics.stage('ffmpeg'):
+            subprocess.run([
+                'ffmpeg', *source.input_args(), *args, '-y', output_path
+            ], check=True, capture_output=True, text=True)
+
+    # the byte budget bounds the output when it is on, so that much is reserved for it
+    output_path = scratch.create('.mp4', encode, config.TARGET_SIZE_BYTES if config.TARGET_SIZE_ENCODING else None)
+    if config.TARGET_SIZE_ENCODING and os.path.getsize(output_path) > config.TARGET_SIZE_BYTES:
+        os.unlink(output_path)
+        raise OutputTooLarge(f"Could not fit the MP4 into {config.TARGET_SIZE_BYTES} bytes")
+    return output_path
+
+def streaming():
+    # a pipe can only be read once, the budget loop and the source cache both need a seekable file
+    return config.STREAM_ENCODING and not config.TARGET_SIZE_ENCODING and not get_source_cache()
+
+def source_request(job):
+    # the smallest stream at least as wide as the output is enough, anything larger is scaled down anyway
+    width = effective_width(job['gif_settings'], job.get('video_width'))
+    if job['gif_settings'].get('format') == 'mp4':
+        # prefer H.264 sources so MP4 animations can be stream-copied
+        return f'worstvideo[vcodec^=avc1][width>={width}]/worstvideo[width>={width}]/bestvideo', 'mp4'
+    source_format = config.STREAM_SOURCE_FORMAT if streaming() else 'mp4'
+    return f'worstvideo[width>={width}]/bestvideo', source_format
+
+def request_source(job, video_format, source_format, start_time=None, end_time=None):
+    with metrics.stage('get_video'):
+        return get_client().get_video(
+            url=job['url'], video_format=video_format, audio_format='worstaudio',
+            output_format=source_format, start_time=start_time or job['start_time'],
+            end_time=end_time or job['end_time'], force_keyframes=True)
+
+def fetch_source(job):
+    video_format, source_format = source_request(job)
+    suffix = f'.{source_format}'
+    cache = get_source_cache()
+    if not cache:
+        result = request_source(job, video_format, source_format)
+        with open_download(result) as response:
+            return Source(download_to_file(response, suffix).name, temporary=True)
+
+    def download(start, end, path):
+        logging.info(f"User {job['user_id']}: Downloading source segment {start}-{end}")
+        result = request_source(job, video_format, source_format, seconds_to_time(start), seconds_to_time(end))
+        with open_download(result) as response, open(path, 'wb') as f, metrics.stage('download'):
+            for chunk in response.iter_content(CHUNK_SIZE):
+                f.write(chunk)
+
+    start = time_to_seconds(job['start_time'])
+    end = time_to_seconds(job['end_time'])
+    variant = (extract_video_id(job['url']), video_format, source_format)
+    path, offset, span, lock = cache.fetch(variant, start, end, suffix, download)
+    if offset == 0 and span == end - start:
+        return Source(path, lock=lock)
+    logging.info(f"User {job['user_id']}: Cutting {start}-{end} from a cached source segment")
+    return Source(path, offset, end - start, lock=lock)
+
+def encode_source(job, source, duration):
+    settings = job['gif_settings']
+    fps = settings['fps']
+    width = effective_width(settings, job.get('video_width'))
+    colors = settings['colors']
+    optimize = settings.get('optimize', DEFAULT_OPTIMIZE)
+    applied = {'fps': fps, 'width': width, 'colors': colors}
+    if settings.get('format') == 'mp4':
+        return encode_mp4_file(source, fps, width, duration, job['user_id']), applied
+    if config.TARGET_SIZE_ENCODING:
+        return encode_gif_to_budget(job, source, fps, width, colors, duration, optimize)
+    return encode_gif(job, source, fps, width, colors, optimize=optimize), applied
+
+def render_mp4(job, progress=None):
+    report = progress or (lambda stage: None)
+    settings = job['gif_settings']
+    logging.info(f"User {job['user_id']}: Using MP4 settings FPS:{settings['fps']}, Width:{effective_width(settings, job.get('video_width'))}")
+
+    report('downloading')
+    source = fetch_source(job)
+    try:
+        report('encoding')
+        return encode_source(job, source, time_to_seconds(job['end_time']) - time_to_seconds(job['start_time']))
+    finally:
+        source.release()
+
+def group_clips(clips, max_span):
+    # neighbouring clips share one downloaded span as long as it stays below max_span seconds
+    groups = []
+    for index, (start, end) in sorted(enumerate(clips), key=lambda item: item[1]):
+        if groups and max(groups[-1][1], end) - groups[-1][0] <= max_span:
+            groups[-1][1] = max(groups[-1][1], end)
+            groups[-1][2].append((index, start, end))
+        else:
+            groups.append([start, end, [(index, start, end)]])
+    return groups
+
+def render_batch(job, progress=None):
+    report = progress or (lambda stage: None)
+    user_id = job['user_id']
+    clips = [(time_to_seconds(start), time_to_seconds(end)) for start, end in job['clips']]
+    groups = group_clips(clips, config.BATCH_MAX_SPAN)
+    logging.info(f"User {user_id}: Rendering {len(clips)} clips from {len(groups)} source spans")
+
+    report('downloading')
+    spans = []
+    sources = [None] * len(clips)
+    try:
+        for span_start, span_end, members in groups:
+            span = fetch_source(dict(job, start_time=seconds_to_time(span_start), end_time=seconds_to_time(span_end)))
+            spans.append(span)
+            for index, start, end in members:
+                sources[index] = Source(span.path, span.offset + start - span_start, end - start)
+
+        report('encoding')
+        # every clip is its own ffmpeg and gifsicle pipeline, so threads are enough to use all cores
+        with ThreadPoolExecutor(max_workers=config.BATCH_ENCODE_THREADS or os.cpu_count()) as pool:
+            futures = [
+                pool.submit(encode_source, dict(job, start_time=seconds_to_time(start), end_time=seconds_to_time(end)), source, end - start)
+                for source, (start, end) in zip(sources, clips)]
+        failed = [future.exception() for future in futures if future.exception()]
+        if failed:
+            for future in futures:
+                if not future.exception(): discard_output(future.result()[0])
+            raise failed[0]
+        return [future.result() for future in futures]
+    finally:
+        for span in spans:
+            span.release()
+
+def render_preview(job, progress=None):
+    report = progress or (lambda stage: None)
+    report('downloading')
+    source = fetch_source(job)
+    try:
+        report('encoding')
+        # no palette pass and no gifsicle: the preview only has to be quick and small
+        output = run_pipeline(iter(()), [[
+            'ffmpeg', '-loglevel', 'error', *source.input_args(),
+            '-vf', f'fps={config.PREVIEW_FPS},scale={config.PREVIEW_WIDTH}:-1:flags=fast_bilinear',
+            '-f', 'gif', 'pipe:1'
+        ]])
+        return output, {'fps': config.PREVIEW_FPS, 'width': config.PREVIEW_WIDTH, 'colors': 256}
+    finally:
+        source.release()
+
+def result_size(output):
+    return len(output) if isinstance(output, bytes) else os.path.getsize(output)
+
+def record_encode_stats(job, output_format, applied, elapsed, size):
+    logging.info(f"User {job['user_id']}: Rendered {output_format} in {elapsed:.2f}s, {size} bytes")
+    if not config.ENCODE_STATS_PATH:
+        return
+    record = {
+        'time': time.time(), 'format': output_format, 'seconds': round(elapsed, 3), 'bytes': size,
+        'fps': applied['fps'], 'width': applied['width'], 'colors': applied['colors'],
+        'start_time': job['start_time'], 'end_time': job['end_time'],
+    }
+    try:
+        with open(config.ENCODE_STATS_PATH, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+    except OSError as e:
+        logging.warning(f"Could not write encode stats: {e}")
+
+def render(job, progress=None):
+    output_format = job['gif_settings'].get('format', 'gif')
+    started = time.monotonic()
+    if job.get('kind') == 'preview':
+        output_format = 'preview'
+        output, applied = render_preview(job, progress)
+    elif job.get('kind') == 'batch':
+        results = render_batch(job, progress)
+        elapsed = time.monotonic() - started
+        for output, applied in results:
+            record_encode_stats(job, f'batch_{output_format}', applied, elapsed / len(results), result_size(output))
+        return [output for output, _ in results], [applied for _, applied in results]
+    elif output_format == 'mp4':
+        output, applied = render_mp4(job, progress)
+    else:
+        output, applied = render_gif(job, progress)
+    record_encode_stats(job, output_format, applied, time.monotonic() - started, result_size(output))
+    return output, applied
+
+def render_gif(job, progress=None):
+    report = progress or (lambda stage: None)
+    user_id = job['user_id']
+    settings = job['gif_settings']
+    gif_fps = settings['fps']
+    gif_width = effective_width(settings, job.get('video_width'))
+    gif_colors = settings['colors']
+    logging.info(f"User {user_id}: Using settings FPS:{gif_fps}, Width:{gif_width}, Colors:{gif_colors}")
+
+    report('downloading')
+    applied = {'fps': gif_fps, 'width': gif_width, 'colors': gif_colors}
+    if streaming():
+        video_format, source_format = source_request(job)
+        result = request_source(job, video_format, source_format)
+        with open_download(result) as response:
+            size = int(response.headers.get('Content-Length') or 0)
+            if 0 < size <= config.STREAM_MAX_SOURCE_BYTES:
+                report('encoding')
+                logging.info(f"User {user_id}: Streaming {size} bytes through ffmpeg and gifsicle")
+                # a pipe cannot be read twice, so only an already cached palette saves the buffering palette graph
+                cache = get_palette_cache() if config.PALETTE_ENGINE else None
+                palette_path = cache and cache.get(
+                    extract_video_id(job['url']), gif_colors, gif_width, time_to_seconds(job['start_time']), time_to_seconds(job['end_time']))
+                gif_filter = build_paletteuse_filter(gif_fps, gif_width) if palette_path else build_gif_filter(gif_fps, gif_width, gif_colors)
+                return encode_gif_stream(response, gif_filter, settings.get('optimize', DEFAULT_OPTIMIZE), palette_path), applied
+            logging.info(f"User {user_id}: Source of {size or 'unknown'} bytes is encoded from a temporary file")
+            source = Source(download_to_file(response, f'.{source_format}').name, temporary=True)
+    else:
+        source = fetch_source(job)
+
+    try:
+        report('encoding')
+        return encode_source(job, source, time_to_seconds(job['end_time']) - time_to_seconds(job['start_time']))
+    finally:
+        source.release()
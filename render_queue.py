@@ -0,0 +1,179 @@
+import itertools
+import logging
+import multiprocessing
+import subprocess
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import metrics
+import render
+import scratch
+
+
+class QueueFull(Exception):
+    def __init__(self, position):
+        super().__init__(f"Render queue is full (position {position})")
+        self.position = position
+
+
+class UserLimitReached(Exception):
+    pass
+
+
+def _run_job(job_id, job, progress_queue):
+    def progress(stage):
+        progress_queue.put((job_id, stage))
+    try:
+        with metrics.collect_stages() as stages, scratch.use(job):
+            return render.render(job, progress), stages
+    except subprocess.CalledProcessError as e:
+        # stderr does not survive pickling back to the parent process
+        logging.error(f"Processing failed for user {job['user_id']}. Error: {e.stderr}")
+        raise RuntimeError(f"{e.cmd[0]} exited with code {e.returncode}") from None
+
+
+# a job whose worker process died is started once more in a fresh pool before it counts as failed
+BROKEN_POOL_RETRIES = 1
+
+
+class RenderQueue:
+    def __init__(self, workers, max_depth, per_user_limit, policy=None):
+        self.workers = workers
+        self.max_depth = max_depth
+        self.per_user_limit = per_user_limit
+        # called with (job, queue depth) right before a job starts, may lower its settings
+        self.policy = policy
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._waiting = []
+        self._running = 0
+        self._per_user = defaultdict(int)
+        self._jobs = {}
+        self._pool = None
+        self._runners = None
+        self._progress = None
+
+    def start(self):
+        self._context = multiprocessing.get_context('spawn')
+        self._manager = self._context.Manager()
+        self._progress = self._manager.Queue()
+        self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=self._context)
+        self._runners = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='render')
+        threading.Thread(target=self._progress_loop, name='render-progress', daemon=True).start()
+
+    def depth(self):
+        with self._lock:
+            return len(self._waiting) + self._running
+
+    def position(self, job_id):
+        with self._lock:
+            if job_id in self._waiting:
+                return self._waiting.index(job_id) + 1
+            return 0
+
+    def check(self, user_id):
+        with self._lock:
+            self._check_locked(user_id)
+
+    def _check_locked(self, user_id):
+        if self._per_user.get(user_id, 0) >= self.per_user_limit:
+            raise UserLimitReached()
+        depth = len(self._waiting) + self._running
+        if depth >= self.max_depth:
+            raise QueueFull(depth - self.workers + 1)
+
+    def submit(self, job, on_progress, on_done, on_error):
+        with self._lock:
+            self._check_locked(job['user_id'])
+            job_id = next(self._ids)
+            job['submitted'] = time.time()
+            job['timings'] = {}
+            self._per_user[job['user_id']] += 1
+            self._waiting.append(job_id)
+            self._jobs[job_id] = (job, on_progress)
+            position = len(self._waiting) + self._running - self.workers
+        self._runners.submit(self._run, job_id, job, on_done, on_error)
+        return max(position, 0)
+
+    def _run(self, job_id, job, on_done, on_error):
+        with self._lock:
+            self._waiting.remove(job_id)
+            self._running += 1
+        wait = time.time() - job['submitted']
+        job['timings']['queue_wait'] = wait
+        metrics.QUEUE_WAIT_SECONDS.observe(wait, kind=job.get('kind', 'render'))
+        self._notify_waiting()
+        try:
+            if self.policy:
+                self.policy(job, self.depth())
+            # the job's temporary files live in its scratch directory until on_done has delivered them
+            scratch.create_job(job)
+            gif, stages = self._render(job_id, job)
+            metrics.observe_stages(stages, job['timings'])
+        except Exception as e:
+            self._finish(job_id, job)
+            scratch.release(job)
+            on_error(job, e)
+            return
+        self._finish(job_id, job)
+        try:
+            on_done(job, gif)
+        finally:
+            scratch.release(job)
+
+    def _render(self, job_id, job):
+        for attempt in range(BROKEN_POOL_RETRIES + 1):
+            with self._lock:
+                pool = self._pool
+            try:
+                return pool.submit(_run_job, job_id, job, self._progress).result()
+            except BrokenProcessPool:
+                # a killed or crashed worker process breaks the whole pool, every job running in it gets this error
+                self._replace_pool(pool)
+                if attempt == BROKEN_POOL_RETRIES:
+                    raise
+                logging.warning(f"Render worker process died, retrying job of user {job['user_id']}")
+
+    def _replace_pool(self, broken):
+        with self._lock:
+            # the other jobs of the broken pool may have replaced it already
+            if self._pool is not broken:
+                return
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=self._context)
+        logging.error("Render process pool was broken, started a new one")
+        broken.shutdown(wait=False)
+
+    def _finish(self, job_id, job):
+        with self._lock:
+            self._running -= 1
+            self._per_user[job['user_id']] -= 1
+            if not self._per_user[job['user_id']]:
+                del self._per_user[job['user_id']]
+            self._jobs.pop(job_id, None)
+
+    def _notify_waiting(self):
+        with self._lock:
+            waiting = [(position, self._jobs[job_id]) for position, job_id in enumerate(self._waiting, 1)]
+        for position, (job, on_progress) in waiting:
+            self._safe_progress(on_progress, job, 'queued', position)
+
+    def _progress_loop(self):
+        while True:
+            try:
+                job_id, stage = self._progress.get()
+            except (EOFError, OSError):
+                return
+            with self._lock:
+                entry = self._jobs.get(job_id)
+            if entry:
+                job, on_progress = entry
+                self._safe_progress(on_progress, job, stage, 0)
+
+    def _safe_progress(self, on_progress, job, stage, position):
+        try:
+            on_progress(job, stage, position)
+        except Exception as e:
+            logging.warning(f"Progress update failed for user {job['user_id']}: {e}")
@@ -0,0 +1,282 @@
+import errno
+import fcntl
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import config
+
+LOCK_NAME = '.lock'
+# per job directory in RAM: one "file name, reserved bytes" line per file created there
+RESERVED_NAME = '.reserved'
+# lock file in the RAM directory serializing quota checks of all processes sharing it
+LEDGER_NAME = '.ledger'
+# a job directory without a lock file this old was left behind while it was being created
+CREATE_GRACE_SECONDS = 60
+
+_space = None
+# job directory the render running in this worker process writes its temporary files to
+_current = None
+
+
+def out_of_space(error):
+    if isinstance(error, OSError):
+        return error.errno == errno.ENOSPC
+    # ffmpeg and gifsicle only say so on stderr
+    return isinstance(error, subprocess.CalledProcessError) and 'No space left on device' in str(error.stderr or '')
+
+
+class ScratchSpace:
+    def __init__(self, ram_dir, disk_dir, ram_quota, unknown_size):
+        self.disk_dir = disk_dir
+        self.ram_quota = ram_quota
+        # room reserved for files whose final size is not known when they are created
+        self.unknown_size = unknown_size
+        self._lock = threading.Lock()
+        # job name -> open lock file, held until the job's outputs are delivered
+        self._locks = {}
+        os.makedirs(disk_dir, exist_ok=True)
+        self.ram_dir = None
+        if ram_dir:
+            try:
+                os.makedirs(ram_dir, exist_ok=True)
+                stat = os.statvfs(ram_dir)
+                self.ram_dir = os.path.abspath(ram_dir)
+            except OSError as e:
+                logging.warning(f"RAM scratch directory {ram_dir} is not usable, using {disk_dir} only: {e}")
+            else:
+                # a quota above the size of the tmpfs would only turn into ENOSPC errors
+                size = stat.f_blocks * stat.f_frsize
+                if size < ram_quota:
+                    logging.info(f"RAM scratch quota lowered to the {size} byte size of {ram_dir}")
+                    self.ram_quota = size
+
+    def create_job(self):
+        name = uuid.uuid4().hex
+        # the directory is locked under a temporary name, so a sweep never sees it unlocked
+        tmp_dir = os.path.join(self.disk_dir, f".{name}.new")
+        os.makedirs(tmp_dir)
+        lock = open(os.path.join(tmp_dir, LOCK_NAME), 'w')
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        os.rename(tmp_dir, os.path.join(self.disk_dir, name))
+        with self._lock:
+            self._locks[name] = lock
+        return name
+
+    def release(self, name):
+        with self._lock:
+            lock = self._locks.pop(name, None)
+        if lock is None:
+            return
+        self._remove(name)
+        lock.close()
+
+    def _remove(self, name):
+        for root in filter(None, (self.ram_dir, self.disk_dir)):
+            shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+    def in_ram(self, path):
+        return bool(self.ram_dir) and os.path.dirname(os.path.dirname(os.path.abspath(path))) == self.ram_dir
+
+    def new_file(self, name, suffix, size=None, on_disk=False):
+        # RAM while the quota and the tmpfs itself have room for the file, disk beyond that
+        if self.ram_dir and not on_disk:
+            needed = size or self.unknown_size
+            with open(os.path.join(self.ram_dir, LEDGER_NAME), 'a') as ledger:
+                # other jobs and worker processes check the quota against the same reservations
+                fcntl.flock(ledger, fcntl.LOCK_EX)
+                stat = os.statvfs(self.ram_dir)
+                if self._ram_usage() + needed <= self.ram_quota and needed <= stat.f_bavail * stat.f_frsize:
+                    try:
+                        path = self._create(self.ram_dir, name, suffix)
+                        with open(os.path.join(self.ram_dir, name, RESERVED_NAME), 'a') as reserved:
+                            reserved.write(f"{os.path.basename(path)} {needed}\n")
+                        return path
+                    except OSError as e:
+                        if not out_of_space(e):
+                            raise
+        return self._create(self.disk_dir, name, suffix)
+
+    @staticmethod
+    def _create(root, name, suffix):
+        directory = os.path.join(root, name)
+        os.makedirs(directory, exist_ok=True)
+        fd, path = tempfile.mkstemp(suffix=suffix, dir=directory)
+        os.close(fd)
+        return path
+
+    def _ram_usage(self):
+        # a file counts with its reservation until it outgrows it, and stops counting once it is removed
+        total = 0
+        for name in os.listdir(self.ram_dir):
+            directory = os.path.join(self.ram_dir, name)
+            reserved = {}
+            try:
+                with open(os.path.join(directory, RESERVED_NAME)) as f:
+                    for line in f:
+                        filename, _, size = line.rpartition(' ')
+                        reserved[filename] = int(size)
+            except (FileNotFoundError, NotADirectoryError, ValueError):
+                pass
+            try:
+                entries = list(os.scandir(directory))
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            for entry in entries:
+                try:
+                    total += max(entry.stat().st_size, reserved.get(entry.name, 0))
+                except FileNotFoundError:
+                    pass
+        return total
+
+    @staticmethod
+    def _usage(root):
+        total = 0
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                try:
+                    total += os.path.getsize(os.path.join(dirpath, filename))
+                except FileNotFoundError:
+                    pass
+        return total
+
+    def usage(self):
+        usage = {'disk': self._usage(self.disk_dir)}
+        if self.ram_dir:
+            usage['ram'] = self._usage(self.ram_dir)
+        return usage
+
+    def _orphaned(self, name):
+        lock_path = os.path.join(self.disk_dir, name, LOCK_NAME)
+        try:
+            lock = open(lock_path, 'a')
+        except FileNotFoundError:
+            try:
+                age = time.time() - os.path.getmtime(os.path.join(self.disk_dir, name))
+            except FileNotFoundError:
+                age = CREATE_GRACE_SECONDS
+            return age >= CREATE_GRACE_SECONDS
+        with lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            return True
+
+    def sweep(self):
+        # job directories whose lock is free belong to a process that died before delivering them
+        names = set()
+        for root in filter(None, (self.ram_dir, self.disk_dir)):
+            names.update(os.listdir(root))
+        names.discard(LEDGER_NAME)
+        removed = 0
+        for name in names:
+            if name in self._locks or not self._orphaned(name):
+                continue
+            self._remove(name)
+            removed += 1
+        if removed:
+            logging.warning(f"Scratch space: removed {removed} orphaned job directories")
+        return removed
+
+
+class ScratchFile:
+    # write-only file that moves itself to disk when its copy in RAM runs the tmpfs out of space
+    def __init__(self, suffix, size=None):
+        self.suffix = suffix
+        self.size = size
+        self.name = new_file(suffix, size)
+        # unbuffered, so a failed write tells exactly what did not reach the file
+        self._file = open(self.name, 'wb', buffering=0)
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            try:
+                written = self._file.write(view)
+            except OSError as e:
+                if not out_of_space(e) or not get_space().in_ram(self.name):
+                    raise
+                self._move_to_disk()
+                continue
+            view = view[written:]
+
+    def _move_to_disk(self):
+        logging.warning(f"Scratch space in RAM is full, moving {self.name} to disk")
+        path = new_file(self.suffix, self.size, on_disk=True)
+        self._file.close()
+        shutil.copyfile(self.name, path)
+        os.unlink(self.name)
+        self.name = path
+        self._file = open(path, 'ab', buffering=0)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def get_space():
+    global _space
+    if _space is None:
+        disk_dir = config.SCRATCH_DISK_DIR or os.path.join(tempfile.gettempdir(), 'gifbot')
+        _space = ScratchSpace(config.SCRATCH_RAM_DIR, disk_dir, config.SCRATCH_RAM_QUOTA, config.SCRATCH_UNKNOWN_SIZE)
+    return _space
+
+def create_job(job):
+    job['scratch'] = get_space().create_job()
+
+def release(job):
+    if job.get('scratch'):
+        get_space().release(job['scratch'])
+
+@contextmanager
+def use(job):
+    # new_file() puts files into the job's directory while its render runs in this process
+    global _current
+    _current = job.get('scratch')
+    try:
+        yield
+    finally:
+        _current = None
+
+def new_file(suffix, size=None, on_disk=False):
+    if _current is None:
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        os.close(fd)
+        return path
+    return get_space().new_file(_current, suffix, size, on_disk)
+
+def open_file(suffix, size=None):
+    return ScratchFile(suffix, size)
+
+def create(suffix, write, size=None):
+    # write(path) fills the file, e.g. with ffmpeg; if that runs the tmpfs out of space it is done again on disk
+    path = new_file(suffix, size)
+    try:
+        write(path)
+    except (OSError, subprocess.CalledProcessError) as e:
+        os.unlink(path)
+        if _current is None or not out_of_space(e) or not get_space().in_ram(path):
+            raise
+        logging.warning(f"Scratch space in RAM is full, writing {suffix} file to disk instead")
+        path = new_file(suffix, size, on_disk=True)
+        try:
+            write(path)
+        except BaseException:
+            os.unlink(path)
+            raise
+    except BaseException:
+        os.unlink(path)
+        raise
+    return path
@@ -0,0 +1,220 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class Session:
+    __slots__ = (
+        'url', 'title', 'duration', 'start_time', 'end_time', 'message_id',
+        'gif_settings', 'video_width', 'waiting_for', 'prompt_message_id', 'clips', 'updated',
+    )
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+        if self.updated is None:
+            self.updated = time.time()
+
+    def __getitem__(self, name):
+        if name not in self.__slots__ or getattr(self, name) is None:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def __setitem__(self, name, value):
+        setattr(self, name, value)
+
+    def __delitem__(self, name):
+        setattr(self, name, None)
+
+    def get(self, name, default=None):
+        value = getattr(self, name, None)
+        return default if value is None else value
+
+    def to_json(self):
+        return json.dumps({name: getattr(self, name) for name in self.__slots__})
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(**json.loads(data))
+
+
+class SessionStore:
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+
+    def __contains__(self, user_id):
+        return self.get(user_id) is not None
+
+    def __getitem__(self, user_id):
+        session = self.get(user_id)
+        if session is None:
+            raise KeyError(user_id)
+        return session
+
+    def __setitem__(self, user_id, session):
+        if not isinstance(session, Session):
+            session = Session(**session)
+        self.save(user_id, session)
+
+    def __delitem__(self, user_id):
+        self.delete(user_id)
+
+    def flush(self):
+        pass
+
+    def _expired(self, session, now):
+        return now - session.updated > self.ttl
+
+    def start_sweeper(self, interval):
+        def sweep_loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    removed = self.sweep()
+                    if removed:
+                        logging.info(f"Session store: expired {removed} idle sessions")
+                except Exception as e:
+                    logging.error(f"Session sweep failed: {e}")
+        threading.Thread(target=sweep_loop, name='session-sweeper', daemon=True).start()
+
+
+class MemorySessionStore(SessionStore):
+    def __init__(self, max_entries, ttl):
+        super().__init__(max_entries, ttl)
+        self._sessions = OrderedDict()
+
+    def get(self, user_id):
+        now = time.time()
+        with self._lock:
+            session = self._sessions.get(user_id)
+            if session is None:
+                return None
+            if self._expired(session, now):
+                del self._sessions[user_id]
+                return None
+            session.updated = now
+            self._sessions.move_to_end(user_id)
+            return session
+
+    def save(self, user_id, session):
+        session.updated = time.time()
+        with self._lock:
+            self._sessions[user_id] = session
+            self._sessions.move_to_end(user_id)
+            while len(self._sessions) > self.max_entries:
+                self._sessions.popitem(last=False)
+
+    def delete(self, user_id):
+        with self._lock:
+            self._sessions.pop(user_id, None)
+
+    def sweep(self):
+        now = time.time()
+        with self._lock:
+            expired = [user_id for user_id, session in self._sessions.items() if self._expired(session, now)]
+            for user_id in expired:
+                del self._sessions[user_id]
+        return len(expired)
+
+
+class SQLiteSessionStore(SessionStore):
+    def __init__(self, path, max_entries, ttl, flush_interval):
+        super().__init__(max_entries, ttl)
+        self.flush_interval = flush_interval
+        # user_id -> Session to write, or None to delete
+        self._pending = {}
+        # user_id -> last access time of sessions that were only read
+        self._touched = {}
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('''
+            CREATE TABLE IF NOT EXISTS sessions (
+                user_id INTEGER PRIMARY KEY,
+                data TEXT NOT NULL,
+                updated REAL NOT NULL
+            )''')
+        self._db.execute('CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated)')
+        self._db.commit()
+        threading.Thread(target=self._flush_loop, name='session-flush', daemon=True).start()
+
+    def get(self, user_id):
+        now = time.time()
+        with self._lock:
+            if user_id in self._pending:
+                session = self._pending[user_id]
+            else:
+                row = self._db.execute('SELECT data, updated FROM sessions WHERE user_id = ?', (user_id,)).fetchone()
+                session = None
+                if row:
+                    session = Session.from_json(row[0])
+                    session.updated = row[1]
+            if session is None:
+                return None
+            if self._expired(session, now):
+                self._pending[user_id] = None
+                return None
+            session.updated = now
+            if user_id not in self._pending:
+                self._touched[user_id] = now
+            return session
+
+    def save(self, user_id, session):
+        session.updated = time.time()
+        with self._lock:
+            self._pending[user_id] = session
+
+    def delete(self, user_id):
+        with self._lock:
+            self._pending[user_id] = None
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            touched, self._touched = self._touched, {}
+            if not pending and not touched:
+                return
+            try:
+                with self._db:
+                    # a plain UPDATE, so a session deleted by another process is not brought back
+                    self._db.executemany(
+                        'UPDATE sessions SET updated = ? WHERE user_id = ?',
+                        [(updated, user_id) for user_id, updated in touched.items() if user_id not in pending])
+                    self._db.executemany(
+                        'INSERT OR REPLACE INTO sessions (user_id, data, updated) VALUES (?, ?, ?)',
+                        [(user_id, session.to_json(), session.updated) for user_id, session in pending.items() if session])
+                    self._db.executemany(
+                        'DELETE FROM sessions WHERE user_id = ?',
+                        [(user_id,) for user_id, session in pending.items() if session is None])
+                    self._db.execute('''
+                        DELETE FROM sessions WHERE user_id IN (
+                            SELECT user_id FROM sessions ORDER BY updated DESC LIMIT -1 OFFSET ?
+                        )''', (self.max_entries,))
+            except sqlite3.Error:
+                # keep the batch so it is retried on the next flush, newer writes win
+                pending.update(self._pending)
+                self._pending = pending
+                raise
+
+    def sweep(self):
+        self.flush()
+        with self._lock, self._db:
+            return self._db.execute('DELETE FROM sessions WHERE updated < ?', (time.time() - self.ttl,)).rowcount
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"Session flush failed: {e}")
+
+
+def create_session_store(backend, max_entries, ttl, path=None, flush_interval=1):
+    if backend == 'sqlite':
+        return SQLiteSessionStore(path, max_entries, ttl, flush_interval)
+    return MemorySessionStore(max_entries, ttl)
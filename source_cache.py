@@ -0,0 +1,231 @@
+import fcntl
+import hashlib
+import logging
+import os
+import subprocess
+import tempfile
+
+# a segment removed between fetching and locking it is fetched again this many times
+PIN_ATTEMPTS = 3
+
+
+class SourceCache:
+    def __init__(self, directory, max_bytes, max_span):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_span = max_span
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def _prefix(variant):
+        return hashlib.sha1('|'.join(map(str, variant)).encode()).hexdigest()[:20]
+
+    def _path(self, variant, start, end, suffix):
+        return os.path.join(self.directory, f"{self._prefix(variant)}_{start}_{end}{suffix}")
+
+    def _intervals(self, variant, suffix):
+        prefix = self._prefix(variant) + '_'
+        intervals = []
+        for name in os.listdir(self.directory):
+            if not name.startswith(prefix) or not name.endswith(suffix):
+                continue
+            try:
+                start, end = map(int, name[len(prefix):-len(suffix)].split('_'))
+            except ValueError:
+                continue
+            intervals.append((start, end, os.path.join(self.directory, name)))
+        return sorted(intervals)
+
+    def get(self, variant, start, end, suffix):
+        for cached_start, cached_end, path in self._intervals(variant, suffix):
+            if cached_start <= start and end <= cached_end:
+                try:
+                    # mtime doubles as the LRU timestamp
+                    os.utime(path)
+                except FileNotFoundError:
+                    continue
+                return path, start - cached_start, cached_end - cached_start
+        return None
+
+    def fetch(self, variant, start, end, suffix, download):
+        # the segment comes with a shared lock on it; merges and eviction leave locked files in place,
+        # so jobs in other processes can keep reading it until they close the lock
+        for _ in range(PIN_ATTEMPTS):
+            path, offset, span = self._fetch(variant, start, end, suffix, download)
+            lock = self._pin(path)
+            if lock:
+                return path, offset, span, lock
+        raise RuntimeError(f"Cached source segment {path} kept disappearing")
+
+    def _fetch(self, variant, start, end, suffix, download):
+        cached = self.get(variant, start, end, suffix)
+        if cached:
+            return cached
+
+        neighbours = []
+        for s, e, path in self._intervals(variant, suffix):
+            if s <= end and e >= start:
+                # held while they are concatenated, a neighbour removed in the meantime is just left out
+                lock = self._pin(path)
+                if lock:
+                    neighbours.append((s, e, path, lock))
+        try:
+            union_start = min([start] + [s for s, _, _, _ in neighbours])
+            union_end = max([end] + [e for _, e, _, _ in neighbours])
+            if not neighbours or union_end - union_start > self.max_span:
+                path = self._download(variant, start, end, suffix, download)
+                return path, 0, end - start
+            path = self._merge(variant, union_start, union_end, suffix, [n[:3] for n in neighbours], download)
+        finally:
+            for *_, lock in neighbours:
+                lock.close()
+        for _, _, old_path, _ in neighbours:
+            if old_path != path: self._remove(old_path)
+        return path, start - union_start, union_end - union_start
+
+    @staticmethod
+    def _pin(path):
+        try:
+            lock = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        fcntl.flock(lock, fcntl.LOCK_SH)
+        try:
+            # removed or replaced while waiting for the lock
+            current = os.stat(path).st_ino == os.fstat(lock.fileno()).st_ino
+        except FileNotFoundError:
+            current = False
+        if not current:
+            lock.close()
+            return None
+        return lock
+
+    @staticmethod
+    def _remove(path):
+        # returns False while a job still holds the file, it is removed by a later eviction instead
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return True
+        with f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            try:
+                if os.stat(path).st_ino == os.fstat(f.fileno()).st_ino:
+                    os.unlink(path)
+            except FileNotFoundError:
+                pass
+        return True
+
+    def _download_tmp(self, start, end, download):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.part')
+        os.close(fd)
+        try:
+            download(start, end, tmp_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return tmp_path
+
+    def _download(self, variant, start, end, suffix, download):
+        path = self._path(variant, start, end, suffix)
+        os.replace(self._download_tmp(start, end, download), path)
+        self._evict(keep=path)
+        return path
+
+    def _merge(self, variant, start, end, suffix, neighbours, download):
+        pieces, gaps = [], []
+        cursor = start
+        try:
+            for s, e, path in neighbours:
+                if e <= cursor:
+                    continue
+                if s > cursor:
+                    gaps.append(self._download_tmp(cursor, s, download))
+                    pieces.append([gaps[-1], cursor, s])
+                pieces.append([path, s, e])
+                cursor = e
+            if cursor < end:
+                gaps.append(self._download_tmp(cursor, end, download))
+                pieces.append([gaps[-1], cursor, end])
+            path = self._concat(variant, start, end, suffix, pieces)
+        except subprocess.CalledProcessError as e:
+            logging.warning(f"Could not merge cached source segments, downloading {start}-{end} instead: {e.stderr}")
+            path = self._download(variant, start, end, suffix, download)
+        finally:
+            for gap in gaps:
+                if os.path.exists(gap): os.unlink(gap)
+        return path
+
+    def _concat(self, variant, start, end, suffix, pieces):
+        path = self._path(variant, start, end, suffix)
+        fd, list_path = tempfile.mkstemp(dir=self.directory, suffix='.part')
+        tmp_path = list_path[:-len('.part')] + '.merge.part'
+        try:
+            with os.fdopen(fd, 'w') as f:
+                for index, (piece_path, piece_start, piece_end) in enumerate(pieces):
+                    f.write(f"file '{os.path.abspath(piece_path)}'\n")
+                    # every piece starts on a forced keyframe, so overlaps are trimmed from the end of the earlier one
+                    if index + 1 < len(pieces) and pieces[index + 1][1] < piece_end:
+                        f.write(f"outpoint {pieces[index + 1][1] - piece_start}\n")
+            subprocess.run([
+                'ffmpeg', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', list_path,
+                '-c', 'copy', '-f', suffix.lstrip('.').replace('mkv', 'matroska'), '-y', tmp_path
+            ], check=True, capture_output=True, text=True)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(list_path): os.unlink(list_path)
+            if os.path.exists(tmp_path): os.unlink(tmp_path)
+        self._evict(keep=path)
+        return path
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.part'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def usage(self):
+        return sum(size for _, size, _ in self._entries())
+
+    @staticmethod
+    def _superseded(entries):
+        # pieces that were merged into a larger segment while a job still had them open
+        groups = {}
+        for _, _, path in entries:
+            try:
+                prefix, start, rest = os.path.basename(path).split('_', 2)
+                end, suffix = rest.split('.', 1)
+                groups.setdefault((prefix, suffix), []).append((int(start), int(end), path))
+            except ValueError:
+                continue
+        return {
+            path for group in groups.values() for start, end, path in group
+            if any(s <= start and end <= e and other != path for s, e, other in group)
+        }
+
+    def _evict(self, keep):
+        entries = sorted(self._entries())
+        superseded = self._superseded(entries)
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if path in superseded and path != keep and self._remove(path):
+                total -= size
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep or path in superseded:
+                continue
+            if self._remove(path):
+                total -= size
+        if total > self.max_bytes:
+            logging.warning(f"Source cache holds {total} bytes, above its {self.max_bytes} byte budget")
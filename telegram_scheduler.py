@@ -0,0 +1,199 @@
+import itertools
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+
+import metrics
+
+# calls that post, change or remove messages, the ones Telegram's per-chat flood limits apply to
+CHAT_METHOD_PREFIXES = ('send', 'edit', 'delete', 'forward', 'copy')
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def reserve(self, now):
+        # takes a token, going into debt if none is left, and returns how long the caller has to wait for it
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+    def pause(self, now, seconds):
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+        self.updated = now
+
+
+class DeleteBatch:
+    def __init__(self):
+        self.message_ids = []
+        self.sent = False
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+
+def ok_response(result=True):
+    # stands in for calls the scheduler answered without asking Telegram
+    response = requests.Response()
+    response.status_code = 200
+    response.headers['Content-Type'] = 'application/json'
+    response._content = json.dumps({'ok': True, 'result': result}).encode()
+    return response
+
+
+class TelegramScheduler:
+    def __init__(self, send, global_rate, private_rate, group_rate, chat_burst, max_retries, max_entries=10000):
+        # send(method, url, **kwargs) performs the HTTP request, same signature as apihelper.CUSTOM_REQUEST_SENDER
+        self.send = send
+        self.private_rate = private_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = OrderedDict()
+        self._edits = {}
+        self._edit_ids = itertools.count(1)
+        self._deleted = OrderedDict()
+        self._deletes = {}
+
+    def _bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # private chats have positive ids, groups and channels negative ids or @usernames
+            rate = self.private_rate if chat_id.isdigit() else self.group_rate
+            bucket = self._chats[chat_id] = TokenBucket(rate, self.chat_burst)
+            while len(self._chats) > self.max_entries:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    def _wait(self, method_name, chat_id):
+        with self._lock:
+            now = time.monotonic()
+            wait = self._global.reserve(now)
+            if chat_id is not None:
+                wait = max(wait, self._bucket(chat_id).reserve(now))
+        if wait:
+            metrics.TELEGRAM_THROTTLE_SECONDS.observe(wait, method=method_name)
+            time.sleep(wait)
+
+    def _remember_deleted(self, chat_id, message_ids):
+        with self._lock:
+            for message_id in message_ids:
+                self._deleted[(chat_id, str(message_id))] = True
+            while len(self._deleted) > self.max_entries:
+                self._deleted.popitem(last=False)
+
+    def request(self, method, url, **kwargs):
+        method_name = url.rsplit('/', 1)[-1]
+        params = kwargs.get('params') or {}
+        if method_name == 'getUpdates':
+            return self.send(method, url, **kwargs)
+        chat_id = str(params['chat_id']) if 'chat_id' in params and method_name.startswith(CHAT_METHOD_PREFIXES) else None
+        message_id = str(params['message_id']) if 'message_id' in params else None
+
+        if chat_id and message_id and method_name.startswith('edit'):
+            return self._edit(method, url, method_name, chat_id, message_id, kwargs)
+        if chat_id and message_id and method_name == 'deleteMessage':
+            return self._delete(method, url, chat_id, message_id, kwargs)
+        self._wait(method_name, chat_id)
+        response = self._send(method, url, method_name, chat_id, kwargs)
+        if chat_id and method_name == 'deleteMessages' and response.status_code == 200:
+            self._remember_deleted(chat_id, json.loads(params['message_ids']))
+        return response
+
+    def _edit(self, method, url, method_name, chat_id, message_id, kwargs):
+        # only an edit of the same kind replaces a waiting one, a keyboard edit must not drop a caption edit
+        key = (chat_id, message_id, method_name)
+        with self._lock:
+            if key[:2] in self._deleted:
+                metrics.TELEGRAM_COALESCED.inc(method=method_name, reason='deleted')
+                return ok_response()
+            edit_id = self._edits[key] = next(self._edit_ids)
+        self._wait(method_name, chat_id)
+        with self._lock:
+            # a newer edit of the same message arrived while this one was waiting, only the latest is sent
+            obsolete = self._edits.get(key) != edit_id or key[:2] in self._deleted
+            if not obsolete:
+                del self._edits[key]
+        if obsolete:
+            metrics.TELEGRAM_COALESCED.inc(method=method_name, reason='superseded')
+            return ok_response()
+        return self._send(method, url, method_name, chat_id, kwargs)
+
+    def _delete(self, method, url, chat_id, message_id, kwargs):
+        with self._lock:
+            batch = self._deletes.get(chat_id)
+            joined = batch is not None and not batch.sent
+            if not joined:
+                batch = self._deletes[chat_id] = DeleteBatch()
+            batch.message_ids.append(int(message_id))
+        if joined:
+            # another thread is waiting to delete in this chat, its request takes this message along
+            metrics.TELEGRAM_COALESCED.inc(method='deleteMessage', reason='batched')
+            batch.done.wait()
+        else:
+            self._wait('deleteMessage', chat_id)
+            with self._lock:
+                batch.sent = True
+                if self._deletes.get(chat_id) is batch:
+                    del self._deletes[chat_id]
+            try:
+                if len(batch.message_ids) == 1:
+                    batch.response = self._send(method, url, 'deleteMessage', chat_id, kwargs)
+                else:
+                    params = {'chat_id': chat_id, 'message_ids': json.dumps(batch.message_ids)}
+                    batch.response = self._send(
+                        'post', url.rsplit('/', 1)[0] + '/deleteMessages', 'deleteMessages', chat_id, dict(kwargs, params=params))
+            except Exception as e:
+                batch.error = e
+            finally:
+                batch.done.set()
+        if batch.error:
+            raise batch.error
+        if batch.response.status_code == 200:
+            self._remember_deleted(chat_id, [message_id])
+        return batch.response
+
+    def _send(self, method, url, method_name, chat_id, kwargs):
+        for attempt in range(self.max_retries + 1):
+            response = self.send(method, url, **kwargs)
+            if response.status_code != 429 or attempt == self.max_retries or not self._rewind(kwargs.get('files')):
+                return response
+            try:
+                retry_after = response.json()['parameters']['retry_after']
+            except (ValueError, KeyError, TypeError):
+                retry_after = 1
+            metrics.TELEGRAM_RATE_LIMITED.inc(method=method_name)
+            logging.warning(f"Telegram flood limit on {method_name} for chat {chat_id}, retrying in {retry_after}s")
+            with self._lock:
+                now = time.monotonic()
+                # the limit may be per chat or global, without telling which; hold back the chat, or everything for chatless calls
+                (self._bucket(chat_id) if chat_id is not None else self._global).pause(now, retry_after)
+            time.sleep(retry_after)
+        return response
+
+    @staticmethod
+    def _rewind(files):
+        # an upload can only be repeated if every file can be read again from the start
+        for value in (files or {}).values():
+            f = value[1] if isinstance(value, tuple) else value
+            if not hasattr(f, 'seek'):
+                return False
+            try:
+                f.seek(0)
+            except Exception:
+                return False
+        return True
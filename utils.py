@@ -0,0 +1,55 @@
+import re
+from urllib.parse import urlparse, parse_qs
+
+def is_youtube_url(url):
+    try:
+        parsed_url = urlparse(url)
+        return (parsed_url.scheme in ['http', 'https'] and
+                parsed_url.netloc in {
+                    "youtube.com", "www.youtube.com", "m.youtube.com",
+                    "youtu.be", "youtube-nocookie.com"
+                })
+    except Exception:
+        return False
+
+def extract_video_id(url):
+    try:
+        parsed_url = urlparse(url)
+        if parsed_url.netloc == "youtu.be":
+            video_id = parsed_url.path.lstrip('/').split('/')[0]
+        else:
+            video_id = parse_qs(parsed_url.query).get('v', [''])[0]
+            if not video_id:
+                parts = parsed_url.path.strip('/').split('/')
+                if len(parts) >= 2 and parts[0] in ('shorts', 'embed', 'live', 'v'):
+                    video_id = parts[1]
+        return video_id or url
+    except Exception:
+        return url
+
+def time_to_seconds(time_str):
+    try:
+        parts = time_str.split(':')
+        h, m, s = (0, 0, 0)
+        if len(parts) == 3: h, m, s = map(int, parts)
+        elif len(parts) == 2: m, s = map(int, parts)
+        else: s = int(parts[0])
+        return h * 3600 + m * 60 + s
+    except:
+        return 0
+
+def seconds_to_time(seconds):
+    hours = int(seconds // 3600)
+    minutes = int((seconds % 3600) // 60)
+    secs = int(seconds % 60)
+    return f"{hours:02d}:{minutes:02d}:{secs:02d}"
+
+def normalize_time(time_str):
+    # "5", "0:05" and "00:00:05" are the same moment, keys built from times must not tell them apart
+    return seconds_to_time(time_to_seconds(time_str))
+
+def parse_time_range(text):
+    match = re.fullmatch(r'\s*(\d+(?::\d{1,2}){0,2})\s*[-–—]\s*(\d+(?::\d{1,2}){0,2})\s*', text)
+    if not match:
+        return None
+    return time_to_seconds(match.group(1)), time_to_seconds(match.group(2))
@@ -0,0 +1,148 @@
+import argparse
+import logging
+import os
+import shutil
+import signal
+import socket
+import threading
+import time
+
+import config
+import load_policy
+import scratch
+from job_queue import JobStore
+from render import OutputTooLarge
+from render_queue import RenderQueue
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.FileHandler("worker.log"),
+        logging.StreamHandler()
+    ]
+)
+
+
+class Worker:
+    def __init__(self, store, spool_dir, slots, name):
+        self.store = store
+        self.spool_dir = spool_dir
+        self.slots = slots
+        self.name = name
+        self.stopping = False
+        self._lock = threading.Lock()
+        # store job id -> job dict of every job this worker holds a lease on
+        self._leased = {}
+        # the load policy looks at the shared queue, not just the jobs running here
+        self._queue = RenderQueue(slots, slots, slots, lambda job, depth: load_policy.apply(job, store.depth()))
+
+    def run(self):
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self._queue.start()
+        threading.Thread(target=self._heartbeat_loop, name='job-heartbeat', daemon=True).start()
+        logging.info(f"Render worker {self.name} started with {self.slots} slots")
+        while not self.stopping or self._leased:
+            with self._lock:
+                free = not self.stopping and len(self._leased) < self.slots
+            leased = self.store.lease(self.name) if free else None
+            if not leased:
+                time.sleep(config.JOB_POLL_INTERVAL)
+                continue
+            job_id, job, wait = leased
+            job['job_id'] = job_id
+            job['lease_wait'] = wait
+            with self._lock:
+                self._leased[job_id] = job
+            logging.info(f"Leased job {job_id} ({job.get('kind', 'render')}) for user {job['user_id']}")
+            self._queue.submit(job, self.on_progress, self.on_done, self.on_error)
+        logging.info(f"Render worker {self.name} stopped")
+
+    def stop(self, signum, frame):
+        if self.stopping:
+            # second signal, hand unfinished jobs to other workers right away
+            # (no lock, the handler runs on the main thread which may be holding it)
+            leased = list(self._leased)
+            for job_id in leased:
+                self.store.release(job_id, self.name)
+            logging.warning(f"Released {len(leased)} jobs, exiting")
+            os._exit(1)
+        self.stopping = True
+        logging.info("Finishing running jobs before exit, signal again to release them instead")
+
+    def _heartbeat_loop(self):
+        while True:
+            time.sleep(self.store.lease_seconds / 3)
+            with self._lock:
+                leased = list(self._leased)
+            for job_id in leased:
+                try:
+                    if not self.store.heartbeat(job_id, self.name):
+                        logging.warning(f"Lease on job {job_id} was lost, its result will be discarded")
+                except Exception as e:
+                    logging.error(f"Heartbeat for job {job_id} failed: {e}")
+
+    def on_progress(self, job, stage, position):
+        if stage != 'queued':
+            self.store.set_stage(job['job_id'], self.name, stage)
+
+    def spool(self, job, index, output):
+        extension = 'mp4' if job['gif_settings'].get('format') == 'mp4' and job.get('kind') != 'preview' else 'gif'
+        name = f"{job['job_id']}_{index}.{extension}"
+        path = os.path.join(self.spool_dir, name)
+        if isinstance(output, bytes):
+            with open(path + '.part', 'wb') as f:
+                f.write(output)
+            os.replace(path + '.part', path)
+        else:
+            shutil.move(output, path)
+        return name
+
+    def on_done(self, job, result):
+        output, applied = result
+        batch = job.get('kind') == 'batch'
+        names = []
+        try:
+            names = [self.spool(job, index, item) for index, item in enumerate(output if batch else [output])]
+            timings = dict(job['timings'])
+            local_wait = timings.pop('queue_wait', 0)
+            completed = self.store.complete(job['job_id'], self.name, {
+                'outputs': names, 'batch': batch, 'applied': applied,
+                'settings': job['gif_settings'], 'downgraded': job.get('downgraded', False),
+                'stages': timings, 'queue_wait': job['lease_wait'] + local_wait,
+            })
+            if not completed:
+                logging.warning(f"Job {job['job_id']} was taken over by another worker, dropping its result")
+                for name in names:
+                    os.unlink(os.path.join(self.spool_dir, name))
+        except Exception as e:
+            logging.error(f"Could not hand over job {job['job_id']}: {e}")
+            self.store.fail(job['job_id'], self.name, str(e))
+        finally:
+            with self._lock:
+                self._leased.pop(job['job_id'], None)
+
+    def on_error(self, job, error):
+        logging.error(f"Job {job['job_id']} failed for user {job['user_id']}. URL: {job['url']}. Error: {error}")
+        try:
+            self.store.fail(job['job_id'], self.name, str(error), isinstance(error, OutputTooLarge))
+        finally:
+            with self._lock:
+                self._leased.pop(job['job_id'], None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render worker pulling jobs from the shared job queue")
+    parser.add_argument('--slots', type=int, default=config.RENDER_WORKERS, help="jobs rendered in parallel")
+    parser.add_argument('--name', default=f"{socket.gethostname()}:{os.getpid()}", help="worker name stored with its leases")
+    args = parser.parse_args()
+
+    store = JobStore(config.JOB_DB_PATH, config.JOB_LEASE_SECONDS, config.JOB_MAX_ATTEMPTS, config.JOB_DB_WAL)
+    scratch.get_space().sweep()
+    worker = Worker(store, config.JOB_SPOOL_DIR, args.slots, args.name)
+    signal.signal(signal.SIGINT, worker.stop)
+    signal.signal(signal.SIGTERM, worker.stop)
+    worker.run()
+
+if __name__ == '__main__':
+    main()